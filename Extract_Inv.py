@@ -4,8 +4,16 @@ import requests
 import json
 import re
 import pandas as pd
+import numpy as np
 import platform
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pypdf import PdfReader
+from ocr_common import (
+    TEMPLATES_CACHE_FILE, fill_cy_columns, find_formatted_tax_id, find_special_vendor_tax_id,
+    load_cached, normalize_vendor_branches, read_templates_json
+)
 
 # --- Cross-platform Configuration ---
 def get_default_source_dir():
@@ -39,9 +47,44 @@ if not API_KEY:
         except:
             pass
 
+# Pages sent to the Typhoon OCR API concurrently
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", "3"))
+
+# Shared session so page requests reuse pooled keep-alive connections; the
+# pool holds one connection per OCR worker. The OCR POST is billed and not
+# idempotent, so it is only retried (with backoff, honouring Retry-After)
+# when the server can't have processed it: a failed connect, or a 429/503
+# rejection. Read errors and other 5xx responses are not replayed
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=max(8, OCR_WORKERS),
+    max_retries=Retry(
+        total=4,
+        read=0,
+        backoff_factor=1,
+        status_forcelist=(429, 503),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+))
+
 # Script directory for relative paths
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 VENDOR_MASTER_FILE = "Vendor_branch.xlsx"
+# Pre-cleaned vendor master, rebuilt whenever the Excel file is newer
+# (own file: Extract_Inv_local normalizes blank branches differently)
+VENDOR_CACHE_FILE = "Vendor_branch_api.pkl"
+HO_PATTERN = re.compile(r"(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office|H\.?O\.?)", re.IGNORECASE)
+BRANCH_NUM_PATTERN = re.compile(r"(?:สาขา(?:ที่)?(?:ออกใบกำกับภาษี)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})(?!\d)", re.IGNORECASE)
+# Lowercased literals every HO_PATTERN / branch-number match contains (H\.?O\.?
+# makes a bare "ho" enough); a page with none of them skips the regex
+HO_KEYWORDS = ('สำนักงานใหญ่', 'สนญ', 'head', 'ho', 'h.o')
+BRANCH_KEYWORDS = ('สาขา', 'branch')
+CHECKBOX_MARKS = ('☑', '✓', '✔')
+VENDOR_BRANCH_LABEL = 'สาขาที่ออกใบกำกับภาษี'
+
 TEMPLATES_FILE = "document_templates.json"
 
 # Command line arguments or defaults
@@ -64,20 +107,30 @@ if not os.path.exists(OUTPUT_DIR):
 
 # --- Load Document Templates ---
 def load_templates():
-    """Load document templates from JSON file"""
+    """Load document templates from JSON file (cached next to it as a pickle)"""
     path = os.path.join(SCRIPT_DIR, TEMPLATES_FILE)
     if not os.path.exists(path):
         print(f"Warning: Templates file not found: {TEMPLATES_FILE}")
         return None
     
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return load_cached(path, os.path.join(SCRIPT_DIR, TEMPLATES_CACHE_FILE), read_templates_json)
     except Exception as e:
         print(f"Error loading templates: {e}")
         return None
 
 
+def line_prefix_end(text, line_count):
+    """Offset where the first line_count lines of text end (the newline
+    after them), or len(text) if it has fewer lines"""
+    end = -1
+    for _ in range(line_count):
+        end = text.find('\n', end + 1)
+        if end < 0:
+            return len(text)
+    return end
+
+
 def detect_document_type(text, templates):
     """Auto-detect document type based on keywords in text.
     Only 3 document types are supported:
@@ -90,37 +143,28 @@ def detect_document_type(text, templates):
     
     text_lower = text.lower()
     
-    # Check first 15 lines (header) for document title keywords
-    lines = text.split('\n')
-    header_text = "\n".join(lines[:15]).lower()
-    
-    # Strict Header: First 4 lines (Higher priority)
-    strict_header = "\n".join(lines[:4]).lower()
+    # Check first 15 lines (header) for document title keywords: the header
+    # is text_lower[:header_end], searched in place instead of copied out
+    header_end = line_prefix_end(text_lower, 15)
     
     # Priority 1: Check for CY INSTRUCTION (unique keywords)
     cy_template = templates.get("templates", {}).get("cy_instruction", {})
-    cy_keywords = cy_template.get("detect_keywords", [])
-    for keyword in cy_keywords:
-        if keyword.lower() in text_lower:
+    for kw_low in cy_template.get("_detect_keywords_lower", []):
+        if kw_low in text_lower:
             return "cy_instruction"
     
     # Priority 2: Check for ใบวางบิล (Billing Note)
     billing_template = templates.get("templates", {}).get("billing_note", {})
-    billing_keywords = billing_template.get("detect_keywords", [])
-    for keyword in billing_keywords:
-        kw_low = keyword.lower()
-        # Check in strict header first (top 4 lines)
-        if kw_low in strict_header:
-            return "billing_note"
-        # Then check in general header
-        if kw_low in header_text:
+    for kw_low in billing_template.get("_detect_keywords_lower", []):
+        # The strict header (top 4 lines) is part of the header, so one
+        # bounded search covers both
+        if text_lower.find(kw_low, 0, header_end) >= 0:
             return "billing_note"
     
     # Priority 3: Check for Sahatthai Invoice (special case, maps to invoice)
     sahatthai_template = templates.get("templates", {}).get("sahatthai_invoice", {})
-    sahatthai_keywords = sahatthai_template.get("detect_keywords", [])
-    for keyword in sahatthai_keywords:
-        if keyword.lower() in text_lower:
+    for kw_low in sahatthai_template.get("_detect_keywords_lower", []):
+        if kw_low in text_lower:
             return "sahatthai_invoice"  # Will be displayed as Invoice
     
     # Default: Everything else is Invoice
@@ -142,13 +186,13 @@ def extract_field_by_patterns(text, patterns, options=None):
                 value = match.group(1) if match.lastindex and match.lastindex >= 1 else match.group(0)
                 
                 # Clean HTML if specified
-                if options.get("clean_html"):
+                if options.get("clean_html") and '<' in value:
                     value = re.sub(r'<br\s*/?>', ' ', value)
                     value = re.sub(r'<[^>]+>', '', value)
                 
-                # Clean whitespace
-                value = re.sub(r'[\r\n]+', ' ', value)
-                value = re.sub(r'\s+', ' ', value).strip()
+                # Collapse whitespace runs (\r and \n included) and trim; split()
+                # uses the same whitespace set as \s and skips the regex
+                value = " ".join(value.split())
                 
                 # Smart extraction for booking numbers: find pattern like "E BKG13808784"
                 # Extract only text that starts with letters and ends with digits
@@ -220,19 +264,9 @@ def extract_common_fields(text, common_fields_config, doc_type_name=None):
     # Company Tax ID to skip (always extract vendor's Tax ID, not company's)
     COMPANY_TAX_ID = "0105522018355"
     
-    # Special condition: if document contains "สยามคอนเทนเนอร์ เทอร์มินอล", use their Tax ID
-    SIAM_CONTAINER_TAX_ID = "0105531101901"
-    # Special condition: if document contains "สหไทย เทอร์มินอล", use their Tax ID
-    SAHATHAI_TAX_ID = "0107560000192"
-    # Special condition: if document contains "มนต์โลจิสติกส์ เซอร์วิส", use their Tax ID
-    MON_LOGISTICS_TAX_ID = "0105559135291"
-    
-    if "สยามคอนเทนเนอร์ เทอร์มินอล" in text or "สยามคอนเทนเนอร์เทอร์มินอล" in text:
-        result["tax_id"] = SIAM_CONTAINER_TAX_ID
-    elif "สหไทย เทอร์มินอล" in text or "สหไทยเทอร์มินอล" in text:
-        result["tax_id"] = SAHATHAI_TAX_ID
-    elif "มนต์โลจิสติกส์ เซอร์วิส" in text or "มนต์โลจิสติกส์เซอร์วิส" in text:
-        result["tax_id"] = MON_LOGISTICS_TAX_ID
+    special_tax_id = find_special_vendor_tax_id(text)
+    if special_tax_id:
+        result["tax_id"] = special_tax_id
     else:
         # Method 1: Find all 13-digit numbers directly
         all_tax_ids = re.findall(r"\b(\d{13})\b", text)
@@ -241,22 +275,9 @@ def extract_common_fields(text, common_fields_config, doc_type_name=None):
         if vendor_tax_ids:
             result["tax_id"] = vendor_tax_ids[0]
         else:
-            # Method 2: Try pattern with dashes (e.g., 0-1234-56789-01-2)
-            all_dashed = re.findall(r"\b(\d{1}-\d{4}-\d{5}-\d{2}-\d{1})\b", text)
-            for match in all_dashed:
-                clean_id = re.sub(r"\D", "", match)
-                if clean_id != COMPANY_TAX_ID:
-                    result["tax_id"] = clean_id
-                    break
-            
-            # Method 3: Try pattern with spaces (e.g., 0 123456789012)
-            if not result["tax_id"]:
-                spaced_matches = re.findall(r"\b(\d{1}\s+\d{12})\b", text)
-                for match in spaced_matches:
-                    clean_id = re.sub(r"\D", "", match)
-                    if clean_id != COMPANY_TAX_ID:
-                        result["tax_id"] = clean_id
-                        break
+            # Method 2: Try pattern with dashes (e.g., 0-1234-56789-01-2),
+            # Method 3: then with spaces (e.g., 0 123456789012)
+            result["tax_id"] = find_formatted_tax_id(text, COMPANY_TAX_ID)
             
             # Method 4: Keyword-based extraction
             if not result["tax_id"]:
@@ -272,38 +293,41 @@ def extract_common_fields(text, common_fields_config, doc_type_name=None):
     default_hq = branch_config.get("default_hq", "00000")
     pad_zeros = branch_config.get("pad_zeros", 5)
     
+    # The checkbox and vendor-branch regexes need a literal that most pages
+    # don't contain; a substring test skips those scans entirely
+    has_checkbox = any(mark in text for mark in CHECKBOX_MARKS)
+    
     # Priority 1: Look for checked checkbox with branch (☑ สาขาที่ X)
-    checked_branch_match = re.search(r'[☑✓✔]\s*สาขา(?:ที่)?\s*(\d+)', text)
+    checked_branch_match = re.search(r'[☑✓✔]\s*สาขา(?:ที่)?\s*(\d+)', text) if has_checkbox else None
     if checked_branch_match:
         result["branch"] = checked_branch_match.group(1).zfill(pad_zeros)
     else:
         # Priority 2: Look for checked Head Office checkbox
-        checked_hq_match = re.search(r'[☑✓✔]\s*(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office)', text, re.IGNORECASE)
+        checked_hq_match = re.search(r'[☑✓✔]\s*(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office)', text, re.IGNORECASE) if has_checkbox else None
         if checked_hq_match:
             result["branch"] = default_hq
         else:
             # Priority 3: Look for "สาขาที่ออกใบกำกับภาษี คือ XXXXX" pattern (vendor's branch)
-            vendor_branch_match = re.search(r'สาขาที่ออกใบกำกับภาษี\s*(?:คือ|:)?\s*(\d{1,5})', text, re.IGNORECASE)
+            vendor_branch_match = re.search(r'สาขาที่ออกใบกำกับภาษี\s*(?:คือ|:)?\s*(\d{1,5})', text, re.IGNORECASE) if VENDOR_BRANCH_LABEL in text else None
             if vendor_branch_match:
                 result["branch"] = vendor_branch_match.group(1).zfill(pad_zeros)
             else:
                 # Priority 4: Look for "สำนักงานใหญ่ XXXXX" or "HEAD OFFICE XXXXX" (head office with number)
-                hq_with_num_match = re.search(r'(?:สำนักงานใหญ่|HEAD\s*OFFICE)\s*[:\s]?\s*(\d{5})', text, re.IGNORECASE)
+                text_lower = text.lower()
+                has_hq_label = 'สำนักงานใหญ่' in text or 'head' in text_lower
+                hq_with_num_match = re.search(r'(?:สำนักงานใหญ่|HEAD\s*OFFICE)\s*[:\s]?\s*(\d{5})', text, re.IGNORECASE) if has_hq_label else None
                 if hq_with_num_match:
                     result["branch"] = hq_with_num_match.group(1).zfill(pad_zeros)
                 else:
                     # Priority 5: Standard branch pattern (without checkbox context)
-                    branch_match = re.search(r"(?:สาขา(?:ที่)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})(?!\d)", text, re.IGNORECASE)
+                    has_branch_label = any(k in text_lower for k in BRANCH_KEYWORDS)
+                    branch_match = re.search(r"(?:สาขา(?:ที่)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})(?!\d)", text, re.IGNORECASE) if has_branch_label else None
                     if branch_match:
                         result["branch"] = branch_match.group(1).zfill(pad_zeros)
                     else:
-                        # Priority 6: Fall back to Head Office keywords (without number)
-                        ho_match = re.search(r"(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office|H\.?O\.?)", text, re.IGNORECASE)
-                        if ho_match:
-                            result["branch"] = default_hq
-                        else:
-                            # Default to Head Office if nothing found
-                            result["branch"] = default_hq
+                        # Priority 6: Head Office keywords (without number) or nothing
+                        # found both fall back to Head Office
+                        result["branch"] = default_hq
     
     return result
 
@@ -454,11 +478,12 @@ def parse_ocr_data_basic(text):
             result["tax_id"] = re.sub(r"\D", "", tax_pattern_match.group(0))
     
     # Branch
-    ho_match = re.search(r"(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office|H\.?O\.?)", text, re.IGNORECASE)
+    text_lower = text.lower()
+    ho_match = HO_PATTERN.search(text) if any(k in text_lower for k in HO_KEYWORDS) else None
     if ho_match:
         result["branch"] = "00000"
-    else:
-        branch_match = re.search(r"(?:สาขา(?:ที่)?(?:ออกใบกำกับภาษี)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})(?!\d)", text, re.IGNORECASE)
+    elif any(k in text_lower for k in BRANCH_KEYWORDS):
+        branch_match = BRANCH_NUM_PATTERN.search(text)
         if branch_match:
             result["branch"] = branch_match.group(1).zfill(5)
     
@@ -466,8 +491,28 @@ def parse_ocr_data_basic(text):
 
 
 # --- Load Vendor Master (Excel) ---
+def read_vendor_master_excel(path):
+    """Read Vendor_branch.xlsx and normalize the tax ID / branch keys"""
+    df = pd.read_excel(path, dtype=str)
+    df.columns = df.columns.str.strip()
+    
+    req_cols = ['เลขประจำตัวผู้เสียภาษี', 'สาขา', 'Vendor code SAP']
+    if not all(col in df.columns for col in req_cols):
+        raise ValueError(f"Missing columns in Master file (required: {req_cols})")
+
+    df['เลขประจำตัวผู้เสียภาษี'] = df['เลขประจำตัวผู้เสียภาษี'].fillna('').str.replace(r'\D', '', regex=True)
+    
+    df['สาขา'] = normalize_vendor_branches(df['สาขา'])
+    
+    # Also get company name if available
+    cols_to_return = ['เลขประจำตัวผู้เสียภาษี', 'สาขา', 'Vendor code SAP']
+    if 'ชื่อบริษัท' in df.columns:
+        cols_to_return.append('ชื่อบริษัท')
+    
+    return df[cols_to_return]
+
 def load_vendor_master():
-    """Load vendor master data from Excel file"""
+    """Load vendor master data from Excel file (cached next to it as a pickle)"""
     path = os.path.join(SCRIPT_DIR, VENDOR_MASTER_FILE)
     if not os.path.exists(path):
         print(f"Warning: Vendor master file not found: {VENDOR_MASTER_FILE} in {SCRIPT_DIR}")
@@ -475,39 +520,26 @@ def load_vendor_master():
     
     try:
         print(f"Loading Vendor Master from: {path}")
-        df = pd.read_excel(path, dtype=str)
-        df.columns = df.columns.str.strip()
-        
-        req_cols = ['เลขประจำตัวผู้เสียภาษี', 'สาขา', 'Vendor code SAP']
-        if not all(col in df.columns for col in req_cols):
-            print(f"Error: Missing columns in Master file (required: {req_cols})")
-            return None
-
-        df['เลขประจำตัวผู้เสียภาษี'] = df['เลขประจำตัวผู้เสียภาษี'].fillna('').str.replace(r'\D', '', regex=True)
-        
-        def clean_branch(x):
-            x = str(x).strip()
-            # Convert head office keywords to 00000
-            if x in ['สำนักงานใหญ่', 'สนญ', 'สนญ.', 'Head Office', 'H.O.', 'HO']:
-                return '00000'
-            if x.isdigit():
-                return x.zfill(5)
-            return x
-        
-        df['สาขา'] = df['สาขา'].apply(clean_branch)
-        
-        # Also get company name if available
-        cols_to_return = ['เลขประจำตัวผู้เสียภาษี', 'สาขา', 'Vendor code SAP']
-        if 'ชื่อบริษัท' in df.columns:
-            cols_to_return.append('ชื่อบริษัท')
-        
-        return df[cols_to_return]
-        
+        return load_cached(path, os.path.join(SCRIPT_DIR, VENDOR_CACHE_FILE), read_vendor_master_excel)
     except Exception as e:
         print(f"Error reading Vendor file: {e}")
         return None
 
 
+def prefetch_file(path):
+    """Start pulling a source file into the OS page cache"""
+    try:
+        with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                # No fadvise (Windows): reading the file warms the cache
+                while f.read(1 << 20):
+                    pass
+    except OSError:
+        pass
+
+
 # --- Calculate target pages ---
 def get_target_pages(selection_str, total_pages):
     """Parse page selection string and return list of pages to process"""
@@ -558,7 +590,7 @@ def extract_text_from_image(file_path, api_key, pages_list):
     try:
         with open(file_path, 'rb') as file:
             files = {'file': file}
-            response = requests.post(url, files=files, data=data, headers=headers)
+            response = HTTP_SESSION.post(url, files=files, data=data, headers=headers, timeout=300)
 
         if response.status_code == 200:
             result = response.json()
@@ -626,12 +658,27 @@ def main():
         print(f"Error: Source directory not found: {SOURCE_DIR}")
         return
 
-    files = [f for f in os.listdir(SOURCE_DIR) if f.lower().endswith(('.pdf', '.png', '.jpg', '.jpeg'))]
+    # scandir's DirEntry carries the file type from the directory read, so
+    # subfolders named like scans are skipped without an extra stat
+    with os.scandir(SOURCE_DIR) as entries:
+        files = sorted(e.name for e in entries
+                       if e.name.lower().endswith(('.pdf', '.png', '.jpg', '.jpeg')) and e.is_file())
     
     if not files:
         print("No PDF files found.")
         return
 
+    # Source files are read into the page cache in the background, so
+    # PdfReader and the page uploads don't stall on cold reads
+    prefetch_pool = ThreadPoolExecutor(max_workers=4)
+    for filename in files:
+        prefetch_pool.submit(prefetch_file, os.path.join(SOURCE_DIR, filename))
+    
+    # Page OCR calls run on a thread pool; results are consumed in page order
+    ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS)
+    # Pages whose OCR still failed after retries, reported at the end
+    failed_pages = []
+    
     for filename in files:
         file_path = os.path.join(SOURCE_DIR, filename)
         print(f"\nProcessing: {filename}")
@@ -646,9 +693,13 @@ def main():
             target_pages = get_target_pages(PAGE_CONFIG, total_pages)
             print(f"   -> Total Pages: {total_pages}, Target: {target_pages}")
 
-            for page_num in target_pages:
+            page_futures = [
+                (page_num, ocr_pool.submit(extract_text_from_image, file_path, API_KEY, [page_num]))
+                for page_num in target_pages
+            ]
+            for page_num, page_future in page_futures:
                 print(f"      Reading Page {page_num}...")
-                page_text = extract_text_from_image(file_path, API_KEY, pages_list=[page_num])
+                page_text = page_future.result()
                 
                 if page_text:
                     # Save raw OCR text
@@ -711,10 +762,18 @@ def main():
                     data_rows.append(row_data)
                 else:
                     print(f"      Warning: Failed to read page {page_num}")
+                    failed_pages.append(f"{filename} (Page {page_num})")
 
         except Exception as e:
             print(f"   Error reading PDF file: {e}")
 
+    ocr_pool.shutdown(wait=True)
+    prefetch_pool.shutdown(wait=False, cancel_futures=True)
+    
+    if failed_pages:
+        print(f"\n[Warning] {len(failed_pages)} page(s) could not be OCR'd and are missing from the summary:")
+        print("\n".join(f"   - {page}" for page in failed_pages))
+
     # Save and merge data
     if data_rows:
         df = pd.DataFrame(data_rows)
@@ -740,15 +799,15 @@ def main():
             if 'Branch_OCR' in df.columns:
                 df['Branch_OCR'] = df['Branch_OCR'].apply(clean_branch_code)
 
-            df = pd.merge(
-                df, 
-                vendor_df, 
-                left_on=['VendorID_OCR', 'Branch_OCR'], 
-                right_on=['เลขประจำตัวผู้เสียภาษี', 'สาขา'], 
-                how='left'
-            )
-            df.rename(columns={'Vendor code SAP': 'Vendor code', 'ชื่อบริษัท': 'Vendor Name'}, inplace=True)
-            df.drop(columns=['เลขประจำตัวผู้เสียภาษี', 'สาขา'], inplace=True, errors='ignore')
+            # Plain dict lookups keyed on (tax ID, branch) instead of a merge;
+            # the first master row wins if a key is listed more than once
+            vendor_df = vendor_df.drop_duplicates(subset=['เลขประจำตัวผู้เสียภาษี', 'สาขา'])
+            vendor_keys = list(zip(vendor_df['เลขประจำตัวผู้เสียภาษี'], vendor_df['สาขา']))
+            ocr_keys = list(zip(df['VendorID_OCR'], df['Branch_OCR']))
+            for master_col, out_col in (('Vendor code SAP', 'Vendor code'), ('ชื่อบริษัท', 'Vendor Name')):
+                if master_col in vendor_df.columns:
+                    lookup = dict(zip(vendor_keys, vendor_df[master_col]))
+                    df[out_col] = [lookup.get(key) for key in ocr_keys]
         else:
             df['Vendor code'] = ""
 
@@ -771,46 +830,21 @@ def main():
         # For each Invoice row, copy CY values from the most recent 
         # CY INSTRUCTION document that appeared before it (by page order)
         # ============================================================
-        cy_columns = ['CyOrg', 'CyExporter', 'CyInvoiceNo', 'CyBooking', 'CyQty', 'Containers']
-        
-        # Ensure CY columns exist
-        for col in cy_columns:
-            if col not in df.columns:
-                df[col] = ""
-        
-        # Sort by Page to ensure correct order
-        if 'Page' in df.columns:
-            df = df.sort_values('Page', ascending=True).reset_index(drop=True)
-        
-        # Track last CY INSTRUCTION values
-        last_cy_values = {col: "" for col in cy_columns}
-        
-        # Iterate through rows and apply lookup
-        for idx, row in df.iterrows():
-            doc_type = str(row.get('Document Type', '')).strip().lower()
-            
-            # Check if this is a CY INSTRUCTION
-            if 'cy' in doc_type or 'instruction' in doc_type:
-                # Update tracked values from this CY INSTRUCTION
-                for col in cy_columns:
-                    if col in df.columns:
-                        val = row.get(col, "")
-                        if pd.notna(val) and str(val).strip():
-                            last_cy_values[col] = val
-            else:
-                # For other documents (Invoice, etc.), copy the tracked CY values
-                for col in cy_columns:
-                    current_val = row.get(col, "")
-                    # Only fill if the current value is empty
-                    if pd.isna(current_val) or str(current_val).strip() == "":
-                        df.at[idx, col] = last_cy_values[col]
+        df = fill_cy_columns(df)
         
         print(f"Applied CY lookup to {len(df)} rows")
 
         output_excel_path = os.path.join(OUTPUT_DIR, "summary_ocr.xlsx")
         
         try:
-            with pd.ExcelWriter(output_excel_path, engine='openpyxl') as writer:
+            # strings_to_urls off: OCR values that look like URLs stay plain
+            # text and skip xlsxwriter's per-string URL scan (formulas such as
+            # the Link PDF HYPERLINK still need strings_to_formulas)
+            with pd.ExcelWriter(
+                output_excel_path,
+                engine='xlsxwriter',
+                engine_kwargs={'options': {'strings_to_urls': False}}
+            ) as writer:
                 # Define sheet name mapping for document types
                 sheet_name_mapping = {
                     'invoice': 'INVOICE',
@@ -823,95 +857,93 @@ def main():
                     'ใบวางบิล/Billing Note': 'ใบวางบิล'
                 }
                 
-                # Map document types to sheet names
+                # Map document types to sheet names; anything unmapped or missing
+                # goes to INVOICE, so every key is a non-blank sheet name
                 if 'Document Type' in df.columns:
-                    df['_sheet_name'] = df['Document Type'].apply(
-                        lambda x: sheet_name_mapping.get(str(x).strip(), 'INVOICE') if pd.notna(x) else 'INVOICE'
+                    df['_sheet_name'] = (
+                        df['Document Type'].astype('string').str.strip()
+                        .map(sheet_name_mapping).fillna('INVOICE')
                     )
                 else:
                     df['_sheet_name'] = 'INVOICE'
+                # Few distinct sheets: group on integer category codes
+                df['_sheet_name'] = df['_sheet_name'].astype('category')
                 
-                # Define column configuration for each sheet
+                # Define column configuration for each sheet (fixed tuples, looked
+                # up directly by the already-normalized sheet name)
                 sheet_columns = {
-                    'INVOICE': [
+                    'INVOICE': (
                         "Link PDF", "Page", "Document Type", 
                         "VendorID_OCR", "Branch_OCR", "Vendor code", "Vendor Name", 
                         "Document No", "Date", "Amount", 
                         "CyOrg", "CyExporter", "CyInvoiceNo", "CyBooking", "CyQty", "Containers"
-                    ],
-                    'CY_INSTRUCTION': [
+                    ),
+                    'CY_INSTRUCTION': (
                         "Link PDF", "Page", "Document Type", 
                         "CyOrg", "CyExporter", "CyInvoiceNo", "CyBooking", "CyQty", "Containers", "Container_delivery"
-                    ],
-                    'ใบวางบิล': [
+                    ),
+                    'ใบวางบิล': (
                         "Link PDF", "Page", "Document Type", 
                         "VendorID_OCR", "Branch_OCR", "Vendor code", "Vendor Name", 
                         "Document No", "Date", "Amount"
-                    ]
+                    )
                 }
+                default_sheet_cols = sheet_columns['INVOICE']
                 
-                # Group by sheet name and save each group to a separate sheet
-                grouped = df.groupby('_sheet_name', dropna=False)
+                # Group by sheet name once; each sheet is sliced by row position.
+                # Keys are not sorted here; the few sheet names are sorted when
+                # writing, so the workbook's sheet order is unchanged
+                group_indices = df.groupby('_sheet_name', dropna=False, sort=False, observed=True).indices
                 
                 # ============================================================
                 # Calculate Container_delivery for CY_INSTRUCTION:
                 # Count INVOICE rows with matching CyInvoiceNo * 0.5
                 # ============================================================
-                invoice_df = grouped.get_group('INVOICE') if 'INVOICE' in [g[0] for g in grouped] else pd.DataFrame()
-                cy_df_temp = grouped.get_group('CY_INSTRUCTION') if 'CY_INSTRUCTION' in [g[0] for g in grouped] else None
+                invoice_df = df.iloc[group_indices['INVOICE']] if 'INVOICE' in group_indices else pd.DataFrame()
+                cy_df_temp = df.iloc[group_indices['CY_INSTRUCTION']] if 'CY_INSTRUCTION' in group_indices else None
                 
                 if cy_df_temp is not None and not invoice_df.empty and 'CyInvoiceNo' in invoice_df.columns:
-                    # Count invoices per CyInvoiceNo
-                    invoice_counts = invoice_df.groupby('CyInvoiceNo').size().to_dict()
-                    
-                    # Calculate Container_delivery for each CY row
-                    def calc_container_delivery(cy_invoice_no):
-                        if pd.isna(cy_invoice_no) or str(cy_invoice_no).strip() == '':
-                            return ''
-                        count = invoice_counts.get(str(cy_invoice_no).strip(), 0)
-                        if count > 0:
-                            return str(count * 0.5)
-                        return ''
+                    # Container_delivery = invoice count * 0.5 (blank when no invoices)
+                    # CY row positions come straight from the grouping above
+                    cy_idx = group_indices['CY_INSTRUCTION']
                     
-                    # Apply calculation to original df for CY_INSTRUCTION rows
-                    cy_mask = df['_sheet_name'] == 'CY_INSTRUCTION'
-                    if 'Container_delivery' not in df.columns:
-                        df['Container_delivery'] = ''
-                    df.loc[cy_mask, 'Container_delivery'] = df.loc[cy_mask, 'CyInvoiceNo'].apply(calc_container_delivery)
+                    # Factorize invoice and CY keys (stripped once, on both sides)
+                    # together, then count invoices per code with bincount.
+                    # The extra trailing 0 slot is what code -1 (missing key) reads.
+                    invoice_keys = invoice_df['CyInvoiceNo'].dropna().astype(str).str.strip().to_numpy(dtype=object)
+                    cy_keys = df['CyInvoiceNo'].iloc[cy_idx].astype('string').str.strip().to_numpy(dtype=object, na_value=None)
+                    key_codes, unique_keys = pd.factorize(np.concatenate([invoice_keys, cy_keys]))
+                    invoice_codes, cy_codes = key_codes[:len(invoice_keys)], key_codes[len(invoice_keys):]
+                    count_by_code = np.bincount(invoice_codes, minlength=len(unique_keys) + 1)
+                    counts = np.where(cy_keys != '', count_by_code[cy_codes], 0)
                     
-                    # Re-group after adding Container_delivery
-                    grouped = df.groupby('_sheet_name', dropna=False)
+                    # Scatter into one float column (NaN = no matching invoices, left
+                    # blank in Excel) so the values are written as native numbers
+                    delivery = np.full(len(df), np.nan)
+                    delivery[cy_idx] = np.where(counts > 0, counts * 0.5, np.nan)
+                    df['Container_delivery'] = delivery
                 
-                for sheet_name, group_df in grouped:
-                    if pd.isna(sheet_name) or str(sheet_name).strip() == '':
-                        sheet_name = 'INVOICE'
-                    
-                    # Drop the temporary _sheet_name column
-                    group_df = group_df.drop(columns=['_sheet_name'], errors='ignore')
-                    
-                    # Select specific columns for this sheet
-                    target_cols = sheet_columns.get(str(sheet_name).strip(), sheet_columns['INVOICE'])
-                    
-                    # Filter existing columns only
-                    available_cols = [col for col in target_cols if col in group_df.columns]
-                    
-                    # Add missing columns as empty (optional, but good for consistency)
-                    for col in target_cols:
-                        if col not in available_cols:
-                            group_df[col] = ""
-                            available_cols.append(col)
-                    
-                    # Reorder columns matches the target list
-                    # Use a set for faster lookup to avoid duplicates if any
-                    final_cols = [col for col in target_cols if col in group_df.columns]
-                    
-                    # Final filtering and reordering
-                    group_df = group_df[final_cols]
+                # Grouping is done; drop the helper column once for all sheets
+                df = df.drop(columns=['_sheet_name'])
+                
+                sheet_summaries = []
+                for sheet_name in sorted(group_indices):
+                    row_positions = group_indices[sheet_name]
+                    sheet_name = str(sheet_name)
                     
-                    # Reset index for clean output
-                    group_df = group_df.reset_index(drop=True)
-                    group_df.to_excel(writer, index=False, sheet_name=str(sheet_name))
-                    print(f"   -> Sheet '{sheet_name}': {len(group_df)} rows")
+                    # Select, order and blank-fill this sheet's columns first, so
+                    # take() only copies the rows of the columns actually written
+                    target_cols = sheet_columns.get(sheet_name, default_sheet_cols)
+                    group_df = (
+                        df.reindex(columns=target_cols, fill_value="")
+                        .take(row_positions)
+                        .reset_index(drop=True)
+                    )
+                    group_df.to_excel(writer, index=False, sheet_name=sheet_name)
+                    sheet_summaries.append(f"   -> Sheet '{sheet_name}': {len(group_df)} rows")
+                
+                # One write for all per-sheet lines
+                print("\n".join(sheet_summaries))
                 
             print(f"\nSuccess! Output saved at: {output_excel_path}")
             print(f"Total rows: {len(df)}")
@@ -1,19 +1,32 @@
 import os
 import sys
 import requests
-import json
 import re
 import pandas as pd
 import base64
+import hashlib
 import io
-import gc
 import platform
 import shutil
 import subprocess
 import time
+import xlsxwriter
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pypdf import PdfReader
 from pdf2image import convert_from_path
 from PIL import Image, ImageEnhance
+from ocr_common import (
+    TEMPLATES_CACHE_FILE, fill_cy_columns, find_formatted_tax_id, find_special_vendor_tax_id,
+    load_cached, normalize_vendor_branches, read_templates_json
+)
+
+# Regex parser, used to find literals a template pattern requires
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
 
 # --- Cross-platform Configuration ---
 def get_default_poppler_path():
@@ -73,10 +86,55 @@ def get_default_output_dir():
 VLLM_API_URL = os.environ.get("VLLM_API_URL", "http://localhost:8000/v1/chat/completions")
 MODEL_NAME = "typhoon-ai/typhoon-ocr1.5-2b" 
 POPPLER_PATH = os.environ.get("POPPLER_PATH", get_default_poppler_path())
+# Pages OCR'd concurrently per file (vLLM batches concurrent requests)
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", "3"))
+
+# Prompts and token limit sent with every page; they are part of the OCR
+# cache key, so changing any of them re-OCRs instead of reusing old output
+OCR_SYSTEM_PROMPT = "You are an OCR engine. Output only the text found in the image in Markdown format. Do not add any instructions, explanations, or conversational text."
+OCR_USER_PROMPT = "OCR this document. Extract all text, tables, and numbers exactly as shown. Output in Markdown. Do not include instructions or 'Here is the markdown'."
+OCR_MAX_TOKENS = 1024
+
+# Upper bound for PDF rendering; pages are otherwise rendered straight at
+# the resolution preprocess_image would shrink them to
+RENDER_MAX_DPI = 300
+
+# Image inputs under these limits skip preprocessing and are uploaded as-is
+DIRECT_UPLOAD_MIME = {"JPEG": "image/jpeg", "PNG": "image/png"}
+DIRECT_UPLOAD_MAX_BYTES = 2 * 1024 * 1024
+
+# Shared session so page requests reuse pooled keep-alive connections; the
+# pool holds one connection per OCR worker and refused/reset connections
+# are retried briefly instead of failing the page
+HTTP_SESSION = requests.Session()
+HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=max(8, OCR_WORKERS),
+    max_retries=Retry(total=2, backoff_factor=0.2)
+)
+HTTP_SESSION.mount("http://", HTTP_ADAPTER)
+HTTP_SESSION.mount("https://", HTTP_ADAPTER)
 
 # Script directory for relative paths
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATES_FILE = "document_templates.json"
+VENDOR_MASTER_FILE = "Vendor_branch.xlsx"
+# Pre-cleaned vendor master, rebuilt whenever the Excel file is newer
+VENDOR_CACHE_FILE = "Vendor_branch.pkl"
+# Vendor master join keys (tax ID, branch)
+VENDOR_KEY_COLS = ['เลขประจำตัวผู้เสียภาษี', 'สาขา']
+
+# Summary workbook sheet for each document type key / display name
+SHEET_NAME_MAPPING = {
+    'invoice': 'INVOICE',
+    'ใบกำกับภาษี/Invoice': 'INVOICE',
+    'Sahatthai Invoice': 'INVOICE',
+    'sahatthai_invoice': 'INVOICE',
+    'cy_instruction': 'CY_INSTRUCTION',
+    'CY INSTRUCTION': 'CY_INSTRUCTION',
+    'billing_note': 'ใบวางบิล',
+    'ใบวางบิล/Billing Note': 'ใบวางบิล'
+}
 
 # Command line arguments
 if len(sys.argv) >= 3:
@@ -89,21 +147,37 @@ else:
     DOC_TYPE = "auto"
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Raw OCR responses keyed by SHA-256 of the model, prompts, token limit and
+# uploaded image bytes, so reruns over the same scans skip the model entirely.
+# OCR_CACHE=0 bypasses the cache; OCR_CACHE=clear makes main() empty it first
+OCR_CACHE_DIR = os.path.join(OUTPUT_DIR, ".ocr_cache")
+OCR_CACHE = os.environ.get("OCR_CACHE", "1").strip().lower()
+USE_OCR_CACHE = OCR_CACHE not in ("0", "false", "no", "off")
 
 # --- Load Document Templates ---
 def load_templates():
-    """Load document templates from JSON file"""
+    """Load document templates from JSON file (cached next to it as a pickle)"""
     path = os.path.join(SCRIPT_DIR, TEMPLATES_FILE)
     if not os.path.exists(path):
         print(f"Warning: Templates file not found: {TEMPLATES_FILE}")
         return None
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        templates = load_cached(path, os.path.join(SCRIPT_DIR, TEMPLATES_CACHE_FILE), read_templates_json)
+        precompile_template_patterns(templates)
+        return templates
     except Exception as e:
         print(f"Error loading templates: {e}")
         return None
 
+# Lowercased detect_keywords per template keyword list, built once
+DETECT_KEYWORDS = {}
+
+def get_detect_keywords(template):
+    keywords = tuple(template.get("detect_keywords", []))
+    if keywords not in DETECT_KEYWORDS:
+        DETECT_KEYWORDS[keywords] = [keyword.lower() for keyword in keywords]
+    return DETECT_KEYWORDS[keywords]
+
 def detect_document_type(text, templates):
     """Auto-detect document type based on keywords in text"""
     if not text or not templates:
@@ -114,26 +188,33 @@ def detect_document_type(text, templates):
     
     for priority_type in priority_types:
         template = templates.get("templates", {}).get(priority_type, {})
-        keywords = template.get("detect_keywords", [])
-        for keyword in keywords:
-            if keyword.lower() in text_lower:
+        for kw_low in get_detect_keywords(template):
+            if kw_low in text_lower:
                 return priority_type
     
-    lines = text.split('\n')
-    header_text = "\n".join(lines[:15]).lower()
-    scores = {}
+    # First 15 lines, cut from the already-lowered text; maxsplit stops
+    # split() from building a list of every line on the page
+    header_text = "\n".join(text_lower.split('\n', 15)[:15])
     
+    # Header pass first. A header hit is also a body hit (11 points); any
+    # other keyword adds at most 1, so if the header leader beats every other
+    # template's best possible score the full-text pass can't change the result
+    candidates = []
     for doc_type, template in templates.get("templates", {}).items():
         if doc_type in priority_types:
             continue
-        keywords = template.get("detect_keywords", [])
-        score = 0
-        for keyword in keywords:
-            kw_low = keyword.lower()
-            if kw_low in header_text:
-                score += 10
-            if kw_low in text_lower:
-                score += 1
+        keywords = get_detect_keywords(template)
+        header_hits = sum(1 for kw_low in keywords if kw_low in header_text)
+        candidates.append((doc_type, keywords, header_hits))
+    
+    if candidates:
+        leader = max(candidates, key=lambda c: c[2])
+        if leader[2] and all(11 * leader[2] > 10 * c[2] + len(c[1]) for c in candidates if c is not leader):
+            return leader[0]
+    
+    scores = {}
+    for doc_type, keywords, header_hits in candidates:
+        score = 10 * header_hits + sum(1 for kw_low in keywords if kw_low in text_lower)
         if score > 0:
             scores[doc_type] = score
     
@@ -141,27 +222,126 @@ def detect_document_type(text, templates):
         return max(scores, key=scores.get)
     return "invoice"
 
-def extract_field_by_patterns(text, patterns, options=None):
-    """Extract field value using multiple regex patterns"""
+# Fixed regexes used by the parsers, compiled once at import
+NON_DIGIT_PATTERN = re.compile(r'\D')
+BR_TAG_PATTERN = re.compile(r'<br\s*/?>')
+AMOUNT_PATTERN = re.compile(r"([\d,]+\.\d{2})")
+DATE_FALLBACK_PATTERNS = [
+    re.compile(r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{4})'),
+    re.compile(r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2})')
+]
+DATE_SEPARATOR_PATTERN = re.compile(r'[-.]')
+TAX_ID_13_PATTERN = re.compile(r"\b(\d{13})\b")
+CHECKBOX_MARKS = ('☑', '✓', '✔')
+VENDOR_BRANCH_LABEL = 'สาขาที่ออกใบกำกับภาษี'
+CHECKED_BRANCH_PATTERN = re.compile(r'[☑✓✔]\s*สาขา(?:ที่)?\s*(\d+)')
+CHECKED_HQ_PATTERN = re.compile(r'[☑✓✔]\s*(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office)', re.IGNORECASE)
+VENDOR_BRANCH_PATTERN = re.compile(r'สาขาที่ออกใบกำกับภาษี\s*(?:คือ|:)?\s*(\d{1,5})', re.IGNORECASE)
+HQ_WITH_NUM_PATTERN = re.compile(r'(?:สำนักงานใหญ่|HEAD\s*OFFICE)\s*[:\s]?\s*(\d{5})', re.IGNORECASE)
+BRANCH_NUM_PATTERN = re.compile(r"(?:สาขา(?:ที่)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})(?!\d)", re.IGNORECASE)
+HO_PATTERN = re.compile(r"(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office|H\.?O\.?)", re.IGNORECASE)
+# Lowercased literals every HO_PATTERN / branch-number match contains (H\.?O\.?
+# makes a bare "ho" enough); a page with none of them skips the regex
+HO_KEYWORDS = ('สำนักงานใหญ่', 'สนญ', 'head', 'ho', 'h.o')
+BRANCH_KEYWORDS = ('สาขา', 'branch')
+BASIC_DOC_NO_PATTERN = re.compile(r"(?:เลขที่|เอกสารเลขที่|Document\s*No\.?|Ref\.\s*Invoice\s*No\.?)\s*[:\.]?\s*([A-Za-z0-9\-\/]{3,})", re.IGNORECASE)
+BASIC_DATE_PATTERN = re.compile(r"(?:วันที่|วัน\s*เดือน\s*ปี|Date)\s*[:\.]?\s*(\d{1,2}\s+[^\s]+\s+\d{4}|\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})", re.IGNORECASE)
+BASIC_DASHED_TAX_ID_PATTERN = re.compile(r"\b\d{1}-\d{4}-\d{5}-\d{2}-\d{1}\b")
+BASIC_BRANCH_PATTERN = re.compile(r"(?:สาขา(?:ที่)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})", re.IGNORECASE)
+
+# Template regexes compiled once (pattern string -> compiled, None if invalid)
+COMPILED_PATTERNS = {}
+# Pattern string -> lowercased literal every match must contain (or None);
+# a page without it can skip the regex entirely
+PATTERN_LITERALS = {}
+
+def is_prefilter_char(ch):
+    """True if IGNORECASE matches ch only as ch.lower()/ch.upper(), so
+    'literal in text.lower()' is a safe test. i/k/s also match U+0130,
+    U+0131, U+212A and U+017F and are left out."""
+    if ch.lower() == ch.upper():
+        return True
+    return ch.isascii() and ch.isalpha() and ch.lower() not in "iks"
+
+def find_required_literal(pattern):
+    """Longest run of plain characters outside any optional or alternative part"""
+    try:
+        parsed = sre_parse.parse(pattern, re.IGNORECASE | re.DOTALL)
+    except Exception:
+        return None
+    runs = [[]]
+    
+    def walk(items):
+        for op, av in items:
+            if op is sre_parse.LITERAL and is_prefilter_char(chr(av)):
+                runs[-1].append(chr(av))
+                continue
+            runs.append([])
+            if op is sre_parse.SUBPATTERN:
+                walk(av[-1])
+                runs.append([])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+                runs.append([])
+    
+    walk(parsed)
+    literal = max(("".join(run) for run in runs), key=len)
+    return literal.lower() if len(literal) >= 2 else None
+
+def get_compiled_pattern(pattern):
+    if pattern not in COMPILED_PATTERNS:
+        try:
+            COMPILED_PATTERNS[pattern] = re.compile(pattern, re.IGNORECASE | re.DOTALL)
+        except re.error:
+            COMPILED_PATTERNS[pattern] = None
+        PATTERN_LITERALS[pattern] = find_required_literal(pattern) if COMPILED_PATTERNS[pattern] else None
+    return COMPILED_PATTERNS[pattern]
+
+def precompile_template_patterns(templates):
+    """Compile every field pattern (and lowercase detect keywords) up front"""
+    if not templates:
+        return
+    configs = list(templates.get("common_fields", {}).values())
+    for template in templates.get("templates", {}).values():
+        get_detect_keywords(template)
+        configs.extend(template.get("fields", {}).values())
+    for config in configs:
+        if isinstance(config, dict):
+            for pattern in config.get("patterns", []):
+                get_compiled_pattern(pattern)
+
+def extract_field_by_patterns(text, patterns, options=None, text_lower=None):
+    """Extract field value using multiple regex patterns (text_lower, if
+    given, is text.lower() for the required-literal checks)"""
     if not text or not patterns:
         return ""
     options = options or {}
     for pattern in patterns:
         try:
-            match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
+            compiled = get_compiled_pattern(pattern)
+            if compiled is None:
+                continue
+            literal = PATTERN_LITERALS[pattern]
+            if literal:
+                if text_lower is None:
+                    text_lower = text.lower()
+                if literal not in text_lower:
+                    continue
+            match = compiled.search(text)
             if match:
                 value = match.group(1) if match.lastindex and match.lastindex >= 1 else match.group(0)
-                if options.get("clean_html"):
-                    value = re.sub(r'<br\s*/?>', ' ', value)
-                    value = re.sub(r'<[^>]+>', '', value)
-                value = re.sub(r'[\r\n]+', ' ', value)
-                value = re.sub(r'\s+', ' ', value).strip()
+                if options.get("clean_html") and '<' in value:
+                    value = BR_TAG_PATTERN.sub(' ', value)
+                    value = HTML_TAG_PATTERN.sub('', value)
+                # Collapse whitespace runs (\r and \n included) and trim; split()
+                # uses the same whitespace set as \s and skips the regex
+                value = " ".join(value.split())
                 if options.get("min_digits"):
-                    digit_count = len(re.sub(r'\D', '', value))
+                    digit_count = len(NON_DIGIT_PATTERN.sub('', value))
                     if digit_count < options["min_digits"]:
                         continue
                 if options.get("clean_non_digits"):
-                    value = re.sub(r'\D', '', value)
+                    value = NON_DIGIT_PATTERN.sub('', value)
                     if options.get("length"):
                         value = value[:options["length"]]
                 if value:
@@ -180,35 +360,17 @@ def extract_common_fields(text, common_fields_config, doc_type_name=None):
     tax_patterns = tax_config.get("patterns", [])
     COMPANY_TAX_ID = "0105522018355"
     
-    SIAM_CONTAINER_TAX_ID = "0105531101901"
-    SAHATHAI_TAX_ID = "0107560000192"
-    MON_LOGISTICS_TAX_ID = "0105559135291"
-    
-    if "สยามคอนเทนเนอร์ เทอร์มินอล" in text or "สยามคอนเทนเนอร์เทอร์มินอล" in text:
-        result["tax_id"] = SIAM_CONTAINER_TAX_ID
-    elif "สหไทย เทอร์มินอล" in text or "สหไทยเทอร์มินอล" in text:
-        result["tax_id"] = SAHATHAI_TAX_ID
-    elif "มนต์โลจิสติกส์ เซอร์วิส" in text or "มนต์โลจิสติกส์เซอร์วิส" in text:
-        result["tax_id"] = MON_LOGISTICS_TAX_ID
+    special_tax_id = find_special_vendor_tax_id(text)
+    if special_tax_id:
+        result["tax_id"] = special_tax_id
     else:
-        all_tax_ids = re.findall(r"\b(\d{13})\b", text)
+        all_tax_ids = TAX_ID_13_PATTERN.findall(text)
         vendor_tax_ids = [tid for tid in all_tax_ids if tid != COMPANY_TAX_ID]
         if vendor_tax_ids:
             result["tax_id"] = vendor_tax_ids[0]
         else:
-            all_dashed = re.findall(r"\b(\d{1}-\d{4}-\d{5}-\d{2}-\d{1})\b", text)
-            for match in all_dashed:
-                clean_id = re.sub(r"\D", "", match)
-                if clean_id != COMPANY_TAX_ID:
-                    result["tax_id"] = clean_id
-                    break
-            if not result["tax_id"]:
-                spaced_matches = re.findall(r"\b(\d{1}\s+\d{12})\b", text)
-                for match in spaced_matches:
-                    clean_id = re.sub(r"\D", "", match)
-                    if clean_id != COMPANY_TAX_ID:
-                        result["tax_id"] = clean_id
-                        break
+            # Dashed form first, then spaced
+            result["tax_id"] = find_formatted_tax_id(text, COMPANY_TAX_ID)
             if not result["tax_id"]:
                 for pattern in tax_patterns:
                     value = extract_field_by_patterns(text, [pattern], {"clean_non_digits": True, "length": 13})
@@ -220,31 +382,34 @@ def extract_common_fields(text, common_fields_config, doc_type_name=None):
     default_hq = branch_config.get("default_hq", "00000")
     pad_zeros = branch_config.get("pad_zeros", 5)
     
-    checked_branch_match = re.search(r'[☑✓✔]\s*สาขา(?:ที่)?\s*(\d+)', text)
+    # The checkbox and vendor-branch regexes need a literal that most pages
+    # don't contain; a substring test skips those scans entirely
+    has_checkbox = any(mark in text for mark in CHECKBOX_MARKS)
+    checked_branch_match = CHECKED_BRANCH_PATTERN.search(text) if has_checkbox else None
     if checked_branch_match:
         result["branch"] = checked_branch_match.group(1).zfill(pad_zeros)
     else:
-        checked_hq_match = re.search(r'[☑✓✔]\s*(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office)', text, re.IGNORECASE)
+        checked_hq_match = CHECKED_HQ_PATTERN.search(text) if has_checkbox else None
         if checked_hq_match:
             result["branch"] = default_hq
         else:
-            vendor_branch_match = re.search(r'สาขาที่ออกใบกำกับภาษี\s*(?:คือ|:)?\s*(\d{1,5})', text, re.IGNORECASE)
+            vendor_branch_match = VENDOR_BRANCH_PATTERN.search(text) if VENDOR_BRANCH_LABEL in text else None
             if vendor_branch_match:
                 result["branch"] = vendor_branch_match.group(1).zfill(pad_zeros)
             else:
-                hq_with_num_match = re.search(r'(?:สำนักงานใหญ่|HEAD\s*OFFICE)\s*[:\s]?\s*(\d{5})', text, re.IGNORECASE)
+                text_lower = text.lower()
+                has_hq_label = 'สำนักงานใหญ่' in text or 'head' in text_lower
+                hq_with_num_match = HQ_WITH_NUM_PATTERN.search(text) if has_hq_label else None
                 if hq_with_num_match:
                     result["branch"] = hq_with_num_match.group(1).zfill(pad_zeros)
                 else:
-                    branch_match = re.search(r"(?:สาขา(?:ที่)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})(?!\d)", text, re.IGNORECASE)
+                    has_branch_label = any(k in text_lower for k in BRANCH_KEYWORDS)
+                    branch_match = BRANCH_NUM_PATTERN.search(text) if has_branch_label else None
                     if branch_match:
                         result["branch"] = branch_match.group(1).zfill(pad_zeros)
                     else:
-                        ho_match = re.search(r"(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office|H\.?O\.?)", text, re.IGNORECASE)
-                        if ho_match:
-                            result["branch"] = default_hq
-                        else:
-                            result["branch"] = default_hq
+                        # Head office keywords or nothing found: head office either way
+                        result["branch"] = default_hq
     return result
 
 def parse_ocr_data_with_template(text, templates, doc_type="auto"):
@@ -276,6 +441,11 @@ def parse_ocr_data_with_template(text, templates, doc_type="auto"):
     result["branch"] = common_result["branch"]
     
     fields_config = template.get("fields", {})
+    # Lowered once per page for the patterns' required-literal checks
+    text_lower = text.lower()
+    # Text (and lowered text) after the first N lines, shared by fields with
+    # the same skip_lines
+    skipped_texts = {}
     for field_name, field_config in fields_config.items():
         patterns = field_config.get("patterns", [])
         options = {
@@ -284,35 +454,39 @@ def parse_ocr_data_with_template(text, templates, doc_type="auto"):
             "length": field_config.get("length"),
             "min_digits": field_config.get("min_digits")
         }
-        text_to_search = text
+        text_to_search, search_lower = text, text_lower
         skip_lines = field_config.get("skip_lines", 0)
         if skip_lines > 0:
-            lines = text.split('\n')
-            text_to_search = '\n'.join(lines[skip_lines:])
+            if skip_lines not in skipped_texts:
+                # maxsplit leaves the remainder unsplit instead of splitting
+                # every line and joining them back; lower() never adds or
+                # removes newlines, so both splits line up
+                parts = text.split('\n', skip_lines)
+                parts_lower = text_lower.split('\n', skip_lines)
+                skipped_texts[skip_lines] = (
+                    (parts[skip_lines], parts_lower[skip_lines]) if len(parts) > skip_lines else ("", "")
+                )
+            text_to_search, search_lower = skipped_texts[skip_lines]
         
-        value = extract_field_by_patterns(text_to_search, patterns, options)
+        value = extract_field_by_patterns(text_to_search, patterns, options, search_lower)
         
         if not value and field_config.get("fallback") == "last_amount":
-            amounts = re.findall(r"([\d,]+\.\d{2})", text)
+            amounts = AMOUNT_PATTERN.findall(text)
             value = amounts[-1] if amounts else ""
         
         if field_name == "document_no" and value:
-            digits_only = re.sub(r'\D', '', value)
+            digits_only = NON_DIGIT_PATTERN.sub('', value)
             if len(digits_only) == 13 and digits_only.isdigit():
                 value = ""
         
         if field_name == "date" and not value:
-            date_patterns = [
-                r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{4})',
-                r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2})'
-            ]
-            for date_pattern in date_patterns:
-                date_matches = re.findall(date_pattern, text)
+            for date_pattern in DATE_FALLBACK_PATTERNS:
+                date_matches = date_pattern.findall(text)
                 if date_matches:
                     value = date_matches[0]
                     break
         if field_name == "date" and value:
-            value = re.sub(r'[-.]', '/', value)
+            value = DATE_SEPARATOR_PATTERN.sub('/', value)
         
         if field_name in ["document_no", "date", "amount"]:
             result[field_name] = value
@@ -331,29 +505,30 @@ def parse_ocr_data_basic(text):
         return result
     
     # Updated: Support 'เอกสารเลขที่', 'Document No.', 'Ref. Invoice No.'
-    inv_match = re.search(r"(?:เลขที่|เอกสารเลขที่|Document\s*No\.?|Ref\.\s*Invoice\s*No\.?)\s*[:\.]?\s*([A-Za-z0-9\-\/]{3,})", text, re.IGNORECASE)
+    inv_match = BASIC_DOC_NO_PATTERN.search(text)
     result["document_no"] = inv_match.group(1) if inv_match else ""
     
     # Updated: Support 'วัน เดือน ปี', 'Date'
-    date_match = re.search(r"(?:วันที่|วัน\s*เดือน\s*ปี|Date)\s*[:\.]?\s*(\d{1,2}\s+[^\s]+\s+\d{4}|\d{1,2}[\/\-\.]\d{1,2}[\/\-\.]\d{2,4})", text, re.IGNORECASE)
+    date_match = BASIC_DATE_PATTERN.search(text)
     result["date"] = date_match.group(1) if date_match else ""
     
-    amounts = re.findall(r"([\d,]+\.\d{2})", text)
+    amounts = AMOUNT_PATTERN.findall(text)
     result["amount"] = amounts[-1] if amounts else ""
     
-    all_tax_ids = re.findall(r"\b(\d{13})\b", text)
+    all_tax_ids = TAX_ID_13_PATTERN.findall(text)
     if all_tax_ids:
         result["tax_id"] = all_tax_ids[0]
     else:
-        tax_pattern_match = re.search(r"\b\d{1}-\d{4}-\d{5}-\d{2}-\d{1}\b", text)
+        tax_pattern_match = BASIC_DASHED_TAX_ID_PATTERN.search(text)
         if tax_pattern_match:
-            result["tax_id"] = re.sub(r"\D", "", tax_pattern_match.group(0))
+            result["tax_id"] = NON_DIGIT_PATTERN.sub("", tax_pattern_match.group(0))
     
-    ho_match = re.search(r"(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office|H\.?O\.?)", text, re.IGNORECASE)
+    text_lower = text.lower()
+    ho_match = HO_PATTERN.search(text) if any(k in text_lower for k in HO_KEYWORDS) else None
     if ho_match:
         result["branch"] = "00000"
-    else:
-        branch_match = re.search(r"(?:สาขา(?:ที่)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})", text, re.IGNORECASE)
+    elif any(k in text_lower for k in BRANCH_KEYWORDS):
+        branch_match = BASIC_BRANCH_PATTERN.search(text)
         if branch_match:
             result["branch"] = branch_match.group(1).zfill(5)
     return result
@@ -364,7 +539,7 @@ def check_vllm_connection():
     try:
         # Check vLLM models endpoint
         url = VLLM_API_URL.replace("/chat/completions", "/models")
-        response = requests.get(url, timeout=5)
+        response = HTTP_SESSION.get(url, timeout=5)
         return response.status_code == 200
     except:
         return False
@@ -422,30 +597,28 @@ def ensure_vllm_running():
     process.terminate()
     return None
 
+def read_vendor_master_excel(path):
+    """Read Vendor_branch.xlsx and normalize the tax ID / branch keys"""
+    df = pd.read_excel(path, dtype=str)
+    df.columns = df.columns.str.strip()
+    df['เลขประจำตัวผู้เสียภาษี'] = df['เลขประจำตัวผู้เสียภาษี'].fillna('').str.replace(r'\D', '', regex=True)
+    df['สาขา'] = df['สาขา'].fillna('')
+    df['สาขา'] = normalize_vendor_branches(df['สาขา'])
+    
+    cols_to_return = VENDOR_KEY_COLS + ['Vendor code SAP']
+    if 'ชื่อบริษัท' in df.columns:
+        cols_to_return.append('ชื่อบริษัท')
+    return df[cols_to_return]
+
 def load_vendor_master():
-    """Load vendor master data from Excel file"""
-    path = os.path.join(SCRIPT_DIR, "Vendor_branch.xlsx")
+    """Load vendor master data from Excel file (cached next to it as a pickle)"""
+    path = os.path.join(SCRIPT_DIR, VENDOR_MASTER_FILE)
     if not os.path.exists(path):
         return None
     try:
-        df = pd.read_excel(path, dtype=str)
-        df.columns = df.columns.str.strip()
-        df['เลขประจำตัวผู้เสียภาษี'] = df['เลขประจำตัวผู้เสียภาษี'].fillna('').str.replace(r'\D', '', regex=True)
-        df['สาขา'] = df['สาขา'].fillna('').str.strip()
-        
-        def clean_branch(x):
-            x = str(x).strip()
-            if x in ['สำนักงานใหญ่', 'สนญ', 'สนญ.', 'Head Office', 'H.O.', 'HO']:
-                return '00000'
-            if x.isdigit():
-                return x.zfill(5)
-            return x
-        df['สาขา'] = df['สาขา'].apply(clean_branch)
-        
-        cols_to_return = ['เลขประจำตัวผู้เสียภาษี', 'สาขา', 'Vendor code SAP']
-        if 'ชื่อบริษัท' in df.columns:
-            cols_to_return.append('ชื่อบริษัท')
-        return df[cols_to_return]
+        df = load_cached(path, os.path.join(SCRIPT_DIR, VENDOR_CACHE_FILE), read_vendor_master_excel)
+        # Indexed on the join keys so main() can use df.join
+        return df.set_index(VENDOR_KEY_COLS)
     except:
         return None
 
@@ -467,102 +640,200 @@ def get_target_pages(selection_str, total_pages):
     return sorted([p for p in pages if 1 <= p <= total_pages])
 
 def preprocess_image(image, max_size=1280):
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    image = ImageEnhance.Contrast(image).enhance(1.8)
+    # OCR only needs intensity; going to one channel and downscaling first
+    # means the contrast pass touches ~1/20 of the original pixels
+    image = image.convert('L')
     if max(image.size) > max_size:
         image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-    return image
+    return ImageEnhance.Contrast(image).enhance(1.8)
+
+def get_render_dpi(page, max_size=1280):
+    """DPI at which the page's long side renders to ~max_size pixels"""
+    try:
+        long_side_pt = max(float(page.mediabox.width), float(page.mediabox.height))
+    except Exception:
+        return RENDER_MAX_DPI
+    if long_side_pt <= 0:
+        return RENDER_MAX_DPI
+    return max(1, min(RENDER_MAX_DPI, int(max_size * 72 / long_side_pt)))
 
 # --- Updated Extract Function for vLLM (OpenAI Compatible) ---
-def extract_text_from_image(file_path, pages_list):
-    """Extract text from PDF pages using vLLM (Typhoon OCR)"""
-    extracted_pages = []
-    
+def _ocr_page(file_path, page_num, is_pdf, poppler, dpi=RENDER_MAX_DPI):
+    """Render one page and OCR it with vLLM. Returns (page_num, text) or None"""
+    try:
+        print(f"   [Step 1] Rendering/Loading Page {page_num}...")
+        
+        if is_pdf:
+            # JPEG from pdftoppm instead of raw PPM, rendered at the DPI that
+            # already fits max_size: far fewer pixels to rasterize, pipe
+            # through to PIL and resample
+            images = convert_from_path(
+                file_path,
+                first_page=page_num,
+                last_page=page_num,
+                poppler_path=poppler,
+                dpi=dpi,
+                fmt="jpeg",
+                jpegopt={"quality": 90}
+            )
+            if not images:
+                return None
+            img = preprocess_image(images[0])
+            images[0].close()
+        else:
+            img = None
+            try:
+                # Image.open only reads the header; JPEG/PNG files already
+                # within preprocess_image's max_size are sent as-is instead
+                # of being decoded and re-encoded
+                with Image.open(file_path) as src:
+                    if (src.format in DIRECT_UPLOAD_MIME
+                            and max(src.size) <= 1280
+                            and os.path.getsize(file_path) <= DIRECT_UPLOAD_MAX_BYTES):
+                        mime = DIRECT_UPLOAD_MIME[src.format]
+                    else:
+                        img = preprocess_image(src)
+            except Exception as img_err:
+                print(f"   [Error] Could not open image: {img_err}")
+                return None
+        
+        # Encode the upload bytes (images are closed as soon as they're
+        # encoded; refcounting frees the rest, no forced gc pass per page)
+        if img is None:
+            with open(file_path, 'rb') as f:
+                img_bytes = f.read()
+        else:
+            # JPEG q85 is far smaller than PNG for noisy scanned pages,
+            # which shrinks the base64 payload and the upload
+            mime = "image/jpeg"
+            with io.BytesIO() as buffered:
+                img.save(buffered, format="JPEG", quality=85)
+                img_bytes = buffered.getvalue()
+            img.close()
+        
+        # Same model + prompts + token limit + image bytes -> same OCR
+        # output (temperature 0)
+        cache_key = hashlib.sha256()
+        for part in (MODEL_NAME, OCR_SYSTEM_PROMPT, OCR_USER_PROMPT, str(OCR_MAX_TOKENS)):
+            cache_key.update(part.encode("utf-8") + b"\0")
+        cache_key.update(img_bytes)
+        cache_path = os.path.join(OCR_CACHE_DIR, f"{cache_key.hexdigest()}.txt")
+        if USE_OCR_CACHE and os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                raw_content = f.read()
+            print(f"   [Step 3] Page {page_num} loaded from OCR cache.")
+            return (page_num, clean_ocr_text(raw_content))
+        
+        img_str = base64.b64encode(img_bytes).decode("utf-8")
+        del img_bytes
+        
+        print(f"   [Step 2] Sending to AI (vLLM)...")
+        
+        # --- Payload for vLLM / OpenAI Compatible API ---
+        payload = {
+            "model": MODEL_NAME,
+            "messages": [
+                # Explicit System Prompt to prevent hallucination
+                {
+                    "role": "system", 
+                    "content": OCR_SYSTEM_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": OCR_USER_PROMPT},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{mime};base64,{img_str}"
+                            }
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": OCR_MAX_TOKENS,
+            "temperature": 0
+        }
+        
+        headers = {"Content-Type": "application/json"}
+        response = HTTP_SESSION.post(VLLM_API_URL, headers=headers, json=payload, timeout=300)
+        
+        result = None
+        if response.status_code == 200:
+            # --- Parse Response from OpenAI Format ---
+            response_json = response.json()
+            raw_content = response_json["choices"][0]["message"]["content"].strip()
+            
+            # Write to a temp name and rename, so a concurrent or interrupted
+            # run never reads a half-written cache entry
+            if USE_OCR_CACHE:
+                os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.{page_num}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(raw_content)
+                os.replace(tmp_path, cache_path)
+            
+            cleaned = clean_ocr_text(raw_content)
+            result = (page_num, cleaned)
+            print(f"   [Step 3] Page {page_num} Processed.")
+        else:
+            print(f"   [Error] API Status {response.status_code}: {response.text}")
+        
+        return result
+        
+    except Exception as e:
+        print(f"   [Error] Page {page_num}: {e}")
+        return None
+
+def extract_text_from_image(file_path, pages_list, reader=None):
+    """Extract text from PDF pages using vLLM (Typhoon OCR)
+
+    Pages are rendered and sent on OCR_WORKERS threads, so one page renders
+    while another waits on the server. Results keep the pages_list order.
+    """
     poppler = POPPLER_PATH if POPPLER_PATH and os.path.exists(POPPLER_PATH) else None
     
     is_pdf = file_path.lower().endswith('.pdf')
-    if not is_pdf:
+    if is_pdf:
+        if reader is None:
+            reader = PdfReader(file_path)
+        page_dpis = {page_num: get_render_dpi(reader.pages[page_num - 1]) for page_num in pages_list}
+    else:
         pages_list = [1]
+        page_dpis = {1: RENDER_MAX_DPI}
 
-    for page_num in pages_list:
-        try:
-            print(f"   [Step 1] Rendering/Loading Page {page_num}...")
-            
-            if is_pdf:
-                images = convert_from_path(
-                    file_path,
-                    first_page=page_num,
-                    last_page=page_num,
-                    poppler_path=poppler,
-                    dpi=300
-                )
-                if not images:
-                    continue
-                img = preprocess_image(images[0])
-            else:
-                try:
-                    img = Image.open(file_path)
-                    img = preprocess_image(img)
-                except Exception as img_err:
-                    print(f"   [Error] Could not open image: {img_err}")
-                    continue
-            
-            # Convert to Base64
-            buffered = io.BytesIO()
-            img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            
-            print(f"   [Step 2] Sending to AI (vLLM)...")
-            
-            # --- Payload for vLLM / OpenAI Compatible API ---
-            payload = {
-                "model": MODEL_NAME,
-                "messages": [
-                    # Explicit System Prompt to prevent hallucination
-                    {
-                        "role": "system", 
-                        "content": "You are an OCR engine. Output only the text found in the image in Markdown format. Do not add any instructions, explanations, or conversational text."
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "OCR this document. Extract all text, tables, and numbers exactly as shown. Output in Markdown. Do not include instructions or 'Here is the markdown'."},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{img_str}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "max_tokens": 1024,
-                "temperature": 0
-            }
-            
-            headers = {"Content-Type": "application/json"}
-            response = requests.post(VLLM_API_URL, headers=headers, json=payload, timeout=300)
-            
-            if response.status_code == 200:
-                # --- Parse Response from OpenAI Format ---
-                response_json = response.json()
-                raw_content = response_json["choices"][0]["message"]["content"].strip()
-                
-                cleaned = clean_ocr_text(raw_content)
-                extracted_pages.append((page_num, cleaned))
-                print(f"   [Step 3] Page {page_num} Processed.")
-            else:
-                print(f"   [Error] API Status {response.status_code}: {response.text}")
-            
-            del img, img_str, buffered
-            if is_pdf: del images
-            gc.collect()
-            
-        except Exception as e:
-            print(f"   [Error] Page {page_num}: {e}")
+    with ThreadPoolExecutor(max_workers=OCR_WORKERS) as executor:
+        futures = [executor.submit(_ocr_page, file_path, page_num, is_pdf, poppler, page_dpis[page_num])
+                   for page_num in pages_list]
+        results = [future.result() for future in futures]
     
-    return extracted_pages
+    return [result for result in results if result]
+
+def prefetch_file(path):
+    """Start pulling a source file into the OS page cache"""
+    try:
+        with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                # No fadvise (Windows): reading the file warms the cache
+                while f.read(1 << 20):
+                    pass
+    except OSError:
+        pass
+
+def write_text_file(path, text):
+    """Write one page's OCR text (run on the background writer thread)"""
+    with open(path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write(text)
+
+# clean_ocr_text patterns, compiled once. WS_RUN_PATTERN only matches runs
+# that actually change (tabs / 2+ blanks), so single spaces cost nothing.
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+WS_RUN_PATTERN = re.compile(r'[ \t]{2,}|\t')
+BLANK_LINES_PATTERN = re.compile(r'\n\s*\n')
+CHECKED_BOXES_CUT_PATTERN = re.compile(r'^[\s\S]*?checked boxes\.\s*', re.IGNORECASE)
+FORMATTING_RULES_CUT_PATTERN = re.compile(r'^[\s\S]*?Formatting Rules[\s\S]*?(\n\n|\r\n\r\n)', re.IGNORECASE)
 
 def clean_ocr_text(text):
     if not text:
@@ -582,25 +853,24 @@ def clean_ocr_text(text):
     # 1. Filter out known big blocks (like the Formatting Rules one)
     if "Formatting Rules:" in text and "Only return the clean Markdown" in text:
         # Remove everything up to "checked boxes." or end of instructions
-        text = re.sub(r'^[\s\S]*?checked boxes\.\s*', '', text, flags=re.IGNORECASE)
+        text = CHECKED_BOXES_CUT_PATTERN.sub('', text)
         # Also try simpler cut if "checked boxes" isn't there
-        text = re.sub(r'^[\s\S]*?Formatting Rules[\s\S]*?(\n\n|\r\n\r\n)', '', text, flags=re.IGNORECASE)
+        text = FORMATTING_RULES_CUT_PATTERN.sub('', text)
 
     # 2. Check for other conversational starters
-    lines = text.split('\n')
-    if lines:
-        first_line = lines[0].strip()
-        for header in garbage_headers:
-            if header.lower() in first_line.lower():
-                # If found, try to remove the first few lines until we hit data
-                # Simple strategy: remove the first line
-                lines = lines[1:]
-                text = '\n'.join(lines)
-                break
-    
-    text = re.sub(r'<[^>]+>', ' ', text)
-    text = re.sub(r'[ \t]+', ' ', text)
-    text = re.sub(r'\n\s*\n', '\n\n', text)
+    first_line, _, rest = text.partition('\n')
+    first_line = first_line.strip().lower()
+    for header in garbage_headers:
+        if header.lower() in first_line:
+            # If found, try to remove the first few lines until we hit data
+            # Simple strategy: remove the first line
+            text = rest
+            break
+    
+    if '<' in text:
+        text = HTML_TAG_PATTERN.sub(' ', text)
+    text = WS_RUN_PATTERN.sub(' ', text)
+    text = BLANK_LINES_PATTERN.sub('\n\n', text)
     return text.strip()
 
 def main():
@@ -611,6 +881,10 @@ def main():
     print(f"API Endpoint: {VLLM_API_URL}")
     print(f"Model: {MODEL_NAME}")
     
+    if OCR_CACHE == "clear" and os.path.isdir(OCR_CACHE_DIR):
+        shutil.rmtree(OCR_CACHE_DIR)
+        print(f"Cleared OCR cache: {OCR_CACHE_DIR}")
+    
     # --- Auto-Start Logic ---
     vllm_process = ensure_vllm_running()
     
@@ -631,12 +905,27 @@ def main():
         print(f"[ERROR] Source directory not found: {SOURCE_DIR}")
         return
     
-    files = [f for f in os.listdir(SOURCE_DIR) if f.lower().endswith(('.pdf', '.png', '.jpg', '.jpeg'))]
+    # scandir's DirEntry carries the file type from the directory read, so
+    # subfolders named like scans are skipped without an extra stat
+    with os.scandir(SOURCE_DIR) as entries:
+        files = sorted(e.name for e in entries
+                       if e.name.lower().endswith(('.pdf', '.png', '.jpg', '.jpeg')) and e.is_file())
     
     if not files:
         print("No PDF files found.")
         return
     
+    # Source files are read into the page cache in the background, so
+    # PdfReader/poppler don't stall on cold reads of the next file
+    prefetch_pool = ThreadPoolExecutor(max_workers=4)
+    for filename in files:
+        prefetch_pool.submit(prefetch_file, os.path.join(SOURCE_DIR, filename))
+    
+    # Page .txt files are written on a background thread so disk I/O
+    # overlaps parsing and the next file's OCR round-trips
+    txt_writer = ThreadPoolExecutor(max_workers=1)
+    pending_writes = []
+    
     for filename in files:
         file_path = os.path.join(SOURCE_DIR, filename)
         print(f"\n[File] {filename}")
@@ -645,17 +934,18 @@ def main():
                 reader = PdfReader(file_path)
                 total_pages = len(reader.pages)
             else:
+                reader = None
                 total_pages = 1
                 
             ocr_results = extract_text_from_image(
                 file_path,
-                get_target_pages(PAGE_CONFIG, total_pages)
+                get_target_pages(PAGE_CONFIG, total_pages),
+                reader
             )
             
             for p_num, raw_text in ocr_results:
                 txt_path = os.path.join(OUTPUT_DIR, f"{os.path.splitext(filename)[0]}_page{p_num}.txt")
-                with open(txt_path, 'w', encoding='utf-8') as f:
-                    f.write(raw_text)
+                pending_writes.append((txt_path, txt_writer.submit(write_text_file, txt_path, raw_text)))
                 
                 parsed = parse_ocr_data_with_template(raw_text, templates, DOC_TYPE)
                 print(f"   Detected Type: {parsed['document_type_name']}")
@@ -680,16 +970,8 @@ def main():
                     row_data["CyBooking"] = booking_no
                     cy_qty = extra.get("cy_qty", "")
                     row_data["CyQty"] = cy_qty
-                    
-                    containers = ""
-                    if cy_qty:
-                        qty_match = re.match(r'^([\d.]+)', cy_qty)
-                        if qty_match:
-                            try:
-                                containers = str(int(float(qty_match.group(1))))
-                            except:
-                                pass
-                    row_data["Containers"] = containers
+                    # Filled from CyQty for all rows at once below
+                    row_data["Containers"] = ""
                 else:
                     for field_name, value in parsed.get("extra_fields", {}).items():
                         label = field_name.replace("_", " ").title()
@@ -700,8 +982,26 @@ def main():
         except Exception as e:
             print(f"   [Error] {filename}: {e}")
 
+    prefetch_pool.shutdown(wait=False, cancel_futures=True)
+
+    txt_writer.shutdown(wait=True)
+    for txt_path, future in pending_writes:
+        if future.exception():
+            print(f"   [Error] Could not write {os.path.basename(txt_path)}: {future.exception()}")
+
     if data_rows:
         df = pd.DataFrame(data_rows)
+        if 'CyQty' in df.columns:
+            # Containers = integer part of the leading number in CyQty
+            qty = pd.to_numeric(
+                df['CyQty'].astype(str).str.extract(r'^([\d.]+)', expand=False),
+                errors='coerce'
+            )
+            # Garbled OCR numbers too large for int64 are left blank, as the
+            # old per-row int(float()) conversion did on overflow
+            qty = qty.where(qty < 2 ** 63)
+            has_qty = df['Containers'].notna() & qty.notna()
+            df.loc[has_qty, 'Containers'] = qty[has_qty].astype('int64').astype(str)
         if vendor_df is not None:
             print("\nMapping Vendor Code...")
             def clean_branch_code(val):
@@ -715,15 +1015,8 @@ def main():
             if 'Branch_OCR' in df.columns:
                 df['Branch_OCR'] = df['Branch_OCR'].apply(clean_branch_code)
 
-            df = pd.merge(
-                df,
-                vendor_df,
-                left_on=['VendorID_OCR', 'Branch_OCR'],
-                right_on=['เลขประจำตัวผู้เสียภาษี', 'สาขา'],
-                how='left'
-            )
+            df = df.join(vendor_df, on=['VendorID_OCR', 'Branch_OCR'], how='left')
             df.rename(columns={'Vendor code SAP': 'Vendor code'}, inplace=True)
-            df.drop(columns=['เลขประจำตัวผู้เสียภาษี', 'สาขา'], inplace=True, errors='ignore')
         else:
             df['Vendor code'] = ""
         
@@ -739,51 +1032,35 @@ def main():
         
         df = df[final_cols]
 
-        cy_columns = ['CyOrg', 'CyExporter', 'CyInvoiceNo', 'CyBooking', 'CyQty', 'Containers']
-        for col in cy_columns:
-            if col not in df.columns:
-                df[col] = ""
-        
-        if 'Page' in df.columns:
-            df = df.sort_values('Page', ascending=True).reset_index(drop=True)
-        
-        last_cy_values = {col: "" for col in cy_columns}
-        
-        for idx, row in df.iterrows():
-            doc_type = str(row.get('Document Type', '')).strip().lower()
-            if 'cy' in doc_type or 'instruction' in doc_type:
-                for col in cy_columns:
-                    if col in df.columns:
-                        val = row.get(col, "")
-                        if pd.notna(val) and str(val).strip():
-                            last_cy_values[col] = val
-            else:
-                for col in cy_columns:
-                    current_val = row.get(col, "")
-                    if pd.isna(current_val) or str(current_val).strip() == "":
-                        df.at[idx, col] = last_cy_values[col]
+        # Page order, CY INSTRUCTION values forward-filled into the rows after them
+        df = fill_cy_columns(df)
 
         output_excel_path = os.path.join(OUTPUT_DIR, "summary_ocr.xlsx")
         
         try:
-            with pd.ExcelWriter(output_excel_path, engine='openpyxl') as writer:
-                sheet_name_mapping = {
-                    'invoice': 'INVOICE',
-                    'ใบกำกับภาษี/Invoice': 'INVOICE',
-                    'Sahatthai Invoice': 'INVOICE',
-                    'sahatthai_invoice': 'INVOICE',
-                    'cy_instruction': 'CY_INSTRUCTION',
-                    'CY INSTRUCTION': 'CY_INSTRUCTION',
-                    'billing_note': 'ใบวางบิล',
-                    'ใบวางบิล/Billing Note': 'ใบวางบิล'
-                }
+            # Rows go straight to xlsxwriter instead of through to_excel.
+            # constant_memory flushes each row to disk once the next starts
+            # (safe here: rows are written strictly in order). strings_to_urls
+            # off: OCR values that look like URLs stay plain text and skip the
+            # per-string URL scan (the Link PDF HYPERLINK still needs
+            # strings_to_formulas)
+            with xlsxwriter.Workbook(
+                output_excel_path,
+                {'constant_memory': True, 'strings_to_urls': False}
+            ) as workbook:
+                # Same header look as pandas' to_excel
+                header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
                 
                 if 'Document Type' in df.columns:
-                    df['_sheet_name'] = df['Document Type'].apply(
-                        lambda x: sheet_name_mapping.get(str(x).strip(), 'INVOICE') if pd.notna(x) else 'INVOICE'
+                    # Unknown and missing document types both land on INVOICE
+                    df['_sheet_name'] = (
+                        df['Document Type'].astype('string').str.strip()
+                        .map(SHEET_NAME_MAPPING).fillna('INVOICE')
                     )
                 else:
                     df['_sheet_name'] = 'INVOICE'
+                # Few distinct sheets: group on integer category codes
+                df['_sheet_name'] = df['_sheet_name'].astype('category')
                 
                 sheet_columns = {
                     'INVOICE': [
@@ -803,44 +1080,39 @@ def main():
                     ]
                 }
                 
-                grouped = df.groupby('_sheet_name', dropna=False)
+                # One grouping pass: row positions per sheet. Adding
+                # Container_delivery below doesn't move rows, so they stay valid
+                sheet_rows = df.groupby('_sheet_name', dropna=False, observed=True).indices
                 
-                invoice_df = grouped.get_group('INVOICE') if 'INVOICE' in [g[0] for g in grouped] else pd.DataFrame()
-                cy_df_temp = grouped.get_group('CY_INSTRUCTION') if 'CY_INSTRUCTION' in [g[0] for g in grouped] else None
+                invoice_df = df.take(sheet_rows['INVOICE']) if 'INVOICE' in sheet_rows else pd.DataFrame()
                 
-                if cy_df_temp is not None and not invoice_df.empty and 'CyInvoiceNo' in invoice_df.columns:
-                    invoice_counts = invoice_df.groupby('CyInvoiceNo').size().to_dict()
-                    def calc_container_delivery(cy_invoice_no):
-                        if pd.isna(cy_invoice_no) or str(cy_invoice_no).strip() == '':
-                            return ''
-                        count = invoice_counts.get(str(cy_invoice_no).strip(), 0)
-                        if count > 0:
-                            return str(count * 0.5)
-                        return ''
+                if 'CY_INSTRUCTION' in sheet_rows and not invoice_df.empty and 'CyInvoiceNo' in invoice_df.columns:
+                    # Invoices per CyInvoiceNo (keys stripped once, on both sides)
+                    invoice_counts = invoice_df['CyInvoiceNo'].astype('string').str.strip().value_counts()
                     
-                    cy_mask = df['_sheet_name'] == 'CY_INSTRUCTION'
-                    if 'Container_delivery' not in df.columns:
-                        df['Container_delivery'] = ''
-                    df.loc[cy_mask, 'Container_delivery'] = df.loc[cy_mask, 'CyInvoiceNo'].apply(calc_container_delivery)
-                    grouped = df.groupby('_sheet_name', dropna=False)
-                
-                for sheet_name, group_df in grouped:
-                    if pd.isna(sheet_name) or str(sheet_name).strip() == '':
-                        sheet_name = 'INVOICE'
-                    
-                    group_df = group_df.drop(columns=['_sheet_name'], errors='ignore')
-                    target_cols = sheet_columns.get(str(sheet_name).strip(), sheet_columns['INVOICE'])
+                    # Container_delivery = invoice count * 0.5 (blank when no invoices)
+                    # CY row positions come straight from the grouping above
+                    cy_rows = sheet_rows['CY_INSTRUCTION']
+                    cy_keys = df['CyInvoiceNo'].iloc[cy_rows].astype('string').str.strip()
+                    counts = cy_keys.map(invoice_counts).where(cy_keys != '').fillna(0).astype('int64')
                     
-                    available_cols = [col for col in target_cols if col in group_df.columns]
-                    for col in target_cols:
-                        if col not in available_cols:
-                            group_df[col] = ""
-                            available_cols.append(col)
+                    # One float column (NaN = no matching invoices, left blank in Excel),
+                    # as in Extract_Inv.py, so the values are written as native numbers
+                    df['Container_delivery'] = float('nan')
+                    df.iloc[cy_rows, df.columns.get_loc('Container_delivery')] = (counts * 0.5).where(counts > 0).to_numpy()
+                
+                for sheet_name in sorted(sheet_rows):
+                    # _sheet_name values are already the mapped names (never blank or NaN)
+                    # Select the sheet's columns in order; missing ones come back empty
+                    target_cols = sheet_columns.get(sheet_name, sheet_columns['INVOICE'])
+                    group_df = df.take(sheet_rows[sheet_name]).reindex(columns=target_cols, fill_value='')
+                    # Missing values become empty cells (xlsxwriter rejects NaN)
+                    group_df = group_df.astype(object).where(group_df.notna(), None)
                     
-                    final_cols = [col for col in target_cols if col in group_df.columns]
-                    group_df = group_df[final_cols]
-                    group_df = group_df.reset_index(drop=True)
-                    group_df.to_excel(writer, index=False, sheet_name=str(sheet_name))
+                    worksheet = workbook.add_worksheet(sheet_name)
+                    worksheet.write_row(0, 0, target_cols, header_format)
+                    for row_num, row in enumerate(group_df.itertuples(index=False, name=None), start=1):
+                        worksheet.write_row(row_num, 0, row)
                     print(f"   -> Sheet '{sheet_name}': {len(group_df)} rows")
                 
             print(f"\nSuccess! Output saved at: {output_excel_path}")
@@ -16,7 +16,7 @@ ORIGINAL /อันฉบับ
 เลขที่ / NO. G250903985
 ได้รับ จาก/Received From C.P.INTERTRADE CO.,LTD."""
 
-patterns = [
+PATTERNS = [re.compile(p, re.IGNORECASE) for p in [
     r"(BK\d+-OUT\s*\d{5,6})",
     r"No\.?\s*[:\.]?\s*(LF-\d+)",
     r"เลขที่\s*/\s*NO\.?\s*([A-Za-z]\d{5,})",
@@ -31,20 +31,23 @@ patterns = [
     r"Invoice\s*No\.?\s*[:\.]?\s*([A-Za-z0-9\-\/]*\d+[A-Za-z0-9\-\/]*)",
     r"เลขที่\s*[:\.]?\s*([A-Za-z0-9\-\/]*\d+[A-Za-z0-9\-\/]*)",
     r"No\.?\s*[:\.]?\s*([A-Za-z0-9\-\/]*\d[A-Za-z0-9\-\/]*)"
-]
+]]
 
 print(f"Text Lines: {len(text.splitlines())}")
 
-for i, pattern in enumerate(patterns):
-    matches = re.finditer(pattern, text, re.IGNORECASE)
-    for match in matches:
+# Collect the report and print it once instead of once per line
+report = []
+for i, pattern in enumerate(PATTERNS):
+    for match in pattern.finditer(text):
         value = match.group(1) if match.lastindex and match.lastindex >= 1 else match.group(0)
         start = match.start()
         # Find which line it is in
         line_num = text.count('\n', 0, start) + 1
         
-        print(f"Pattern {i} matched at Line {line_num}:")
-        print(f"  Full Match: '{match.group(0)}'")
-        print(f"  Extracted Group: '{value}'")
+        report.append(f"Pattern {i} matched at Line {line_num}:")
+        report.append(f"  Full Match: '{match.group(0)}'")
+        report.append(f"  Extracted Group: '{value}'")
         if value == "5/1":
-            print("  *** FOUND TARGET VALUE '5/1' ***")
+            report.append("  *** FOUND TARGET VALUE '5/1' ***")
+if report:
+    print("\n".join(report))
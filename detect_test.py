@@ -1,11 +1,42 @@
 import json
 import os
 
+try:
+    import ahocorasick
+    HAS_AHOCORASICK = True
+except ImportError:
+    HAS_AHOCORASICK = False
+
 TEMPLATES_FILE = "document_templates.json"
+# Print per-type scores (DETECT_DEBUG=1); off by default so timing runs and
+# callers reusing detect_document_type stay quiet
+DEBUG = os.environ.get("DETECT_DEBUG", "").strip().lower() in ("1", "true", "yes")
 
 def load_templates():
     with open(TEMPLATES_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+        templates = json.load(f)
+    # Lowercase each template's keywords once instead of on every detect call
+    for template in templates.get("templates", {}).values():
+        template["_detect_keywords_lower"] = [k.lower() for k in template.get("detect_keywords", [])]
+    # Reverse index: each distinct keyword -> doc types that list it, so a
+    # keyword shared by several templates is scanned once per detect call
+    keyword_index = {}
+    for doc_type, template in templates.get("templates", {}).items():
+        for kw_low in template["_detect_keywords_lower"]:
+            keyword_index.setdefault(kw_low, []).append(doc_type)
+    templates["_keyword_index"] = keyword_index
+    if HAS_AHOCORASICK:
+        templates["_detect_automaton"] = build_detect_automaton(keyword_index)
+    return templates
+
+def build_detect_automaton(keyword_index):
+    """One automaton over every keyword: keyword -> doc types that list it"""
+    automaton = ahocorasick.Automaton()
+    for kw_low, doc_types in keyword_index.items():
+        if kw_low:
+            automaton.add_word(kw_low, (kw_low, doc_types))
+    automaton.make_automaton()
+    return automaton
 
 def detect_document_type(text, templates):
     """Current logic from Extract_Inv.py"""
@@ -17,42 +48,56 @@ def detect_document_type(text, templates):
     
     for priority_type in priority_types:
         template = templates.get("templates", {}).get(priority_type, {})
-        keywords = template.get("detect_keywords", [])
-        for keyword in keywords:
-            if keyword.lower() in text_lower:
+        for kw_low in template.get("_detect_keywords_lower", []):
+            if kw_low in text_lower:
                 return priority_type
     
-    lines = text.split('\n')
+    lines = text_lower.split('\n', 15)
     # Strict Header: First 4 lines
-    strict_header = "\n".join(lines[:4]).lower()
+    strict_header = "\n".join(lines[:4])
     # General Header: First 15 lines
-    header_text = "\n".join(lines[:15]).lower()
-    
-    scores = {}
+    header_text = "\n".join(lines[:15])
     
-    for doc_type, template in templates.get("templates", {}).items():
-        if doc_type in priority_types:
-            continue
-        
-        keywords = template.get("detect_keywords", [])
-        score = 0
-        for keyword in keywords:
-            kw_low = keyword.lower()
-            
-            # Top 4 lines get SUPER priority
+    # Weight per matched keyword: top 4 lines get SUPER priority (+50),
+    # header +10, and every match counts +1 for the body
+    keyword_weights = []
+    automaton = templates.get("_detect_automaton")
+    if automaton is not None:
+        # Single pass over the text; the headers are prefixes of text_lower,
+        # so the first end index of a keyword tells which regions contain it
+        first_end = {}
+        for end_idx, (kw_low, doc_types) in automaton.iter(text_lower):
+            if kw_low not in first_end:
+                first_end[kw_low] = (end_idx, doc_types)
+        for end_idx, doc_types in first_end.values():
+            if end_idx < len(strict_header):
+                keyword_weights.append((51, doc_types))
+            elif end_idx < len(header_text):
+                keyword_weights.append((11, doc_types))
+            else:
+                keyword_weights.append((1, doc_types))
+    else:
+        for kw_low, doc_types in templates.get("_keyword_index", {}).items():
+            # Headers are part of the text: no body match, no header match
+            if kw_low not in text_lower:
+                continue
             if kw_low in strict_header:
-                score += 50
-            
-            # Normal Header match
+                keyword_weights.append((51, doc_types))
             elif kw_low in header_text:
-                score += 10
-            
-            # Body match
-            if kw_low in text_lower:
-                score += 1
-                
-        if score > 0:
-            scores[doc_type] = score
+                keyword_weights.append((11, doc_types))
+            else:
+                keyword_weights.append((1, doc_types))
+    
+    totals = {}
+    for weight, doc_types in keyword_weights:
+        for doc_type in doc_types:
+            totals[doc_type] = totals.get(doc_type, 0) + weight
+    
+    # Keyed in template order so ties resolve as before
+    scores = {doc_type: totals[doc_type] for doc_type in templates.get("templates", {})
+              if doc_type in totals and doc_type not in priority_types}
+    if DEBUG:
+        for doc_type, score in scores.items():
             print(f"Type: {doc_type}, Score: {score}")
     
     if scores:
@@ -1,5 +1,6 @@
 import os
 import pandas as pd
+import xlsxwriter
 import Extract_Inv  # Import the module with corrected logic
 
 # Define paths
@@ -66,27 +67,24 @@ def generate_excel():
     # Load Vendor Master for mapping (optional but good for completeness)
     vendor_df = Extract_Inv.load_vendor_master()
     if vendor_df is not None:
-         # Clean branch
-        def clean_branch_code(val):
-            s = str(val).strip()
-            if s.lower() in ['nan', 'none', '']:
-                return "00000"
-            if s.isdigit():
-                return s.zfill(5)
-            return s
-
+         # Clean branch: blank -> 00000, numeric -> zero-padded to 5 digits
         if 'Branch_OCR' in df.columns:
-            df['Branch_OCR'] = df['Branch_OCR'].apply(clean_branch_code)
+            # Missing values are checked before the cast, which would turn
+            # them into the text 'nan' / 'None'
+            is_missing = df['Branch_OCR'].isna()
+            branch = df['Branch_OCR'].astype(str).str.strip()
+            is_blank = is_missing | branch.str.lower().isin(['nan', 'none', ''])
+            is_digit = branch.str.isdigit()
+            df['Branch_OCR'] = branch.mask(is_digit, branch.str.zfill(5)).mask(is_blank, '00000')
 
-        df = pd.merge(
-            df, 
-            vendor_df, 
-            left_on=['VendorID_OCR', 'Branch_OCR'], 
-            right_on=['เลขประจำตัวผู้เสียภาษี', 'สาขา'], 
-            how='left'
-        )
-        df.rename(columns={'Vendor code SAP': 'Vendor code', 'ชื่อบริษัท': 'Vendor Name'}, inplace=True)
-        df.drop(columns=['เลขประจำตัวผู้เสียภาษี', 'สาขา'], inplace=True, errors='ignore')
+        # Plain dict lookups keyed on (tax ID, branch), as in Extract_Inv.py
+        vendor_df = vendor_df.drop_duplicates(subset=['เลขประจำตัวผู้เสียภาษี', 'สาขา'])
+        vendor_keys = list(zip(vendor_df['เลขประจำตัวผู้เสียภาษี'], vendor_df['สาขา']))
+        ocr_keys = list(zip(df['VendorID_OCR'], df['Branch_OCR']))
+        for master_col, out_col in (('Vendor code SAP', 'Vendor code'), ('ชื่อบริษัท', 'Vendor Name')):
+            if master_col in vendor_df.columns:
+                lookup = dict(zip(vendor_keys, vendor_df[master_col]))
+                df[out_col] = [lookup.get(key) for key in ocr_keys]
     
     # Output path
     if not os.path.exists(OUTPUT_DIR):
@@ -95,8 +93,15 @@ def generate_excel():
     output_excel_path = os.path.join(OUTPUT_DIR, "summary_ocr.xlsx")
     
     try:
-        with pd.ExcelWriter(output_excel_path, engine='openpyxl') as writer:
-             df.to_excel(writer, index=False, sheet_name='CY_INSTRUCTION')
+        # Rows go straight to xlsxwriter as plain tuples, as in Extract_Inv_local.py
+        with xlsxwriter.Workbook(output_excel_path, {'constant_memory': True, 'strings_to_urls': False}) as workbook:
+            header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+            worksheet = workbook.add_worksheet('CY_INSTRUCTION')
+            worksheet.write_row(0, 0, list(df.columns), header_format)
+            # Missing values become empty cells (xlsxwriter rejects NaN)
+            rows = df.astype(object).where(df.notna(), None)
+            for row_num, row in enumerate(rows.itertuples(index=False, name=None), start=1):
+                worksheet.write_row(row_num, 0, row)
         print(f"Success! Saved to {output_excel_path}")
     except Exception as e:
         print(f"Error saving excel: {e}")
@@ -0,0 +1,140 @@
+"""
+Shared helpers for the OCR extraction scripts
+=============================================
+Used by Extract_Inv.py, Extract_Inv_local.py and test_regex_extraction.py,
+so the caching and parsing rules they have in common live in one place.
+"""
+
+import os
+import re
+import json
+import pickle
+import functools
+import pandas as pd
+
+# Optional: Arrow-backed string columns for the summary DataFrame
+try:
+    import pyarrow
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Parsed templates, rebuilt whenever the JSON file is newer
+TEMPLATES_CACHE_FILE = "document_templates.pkl"
+
+
+# --- On-disk cache for parsed inputs ---
+@functools.lru_cache(maxsize=8)
+def _load_cached(source_path, source_mtime, cache_path, builder):
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= source_mtime:
+        try:
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            pass
+    obj = builder(source_path)
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+    return obj
+
+def load_cached(source_path, cache_path, builder):
+    """Return builder(source_path), pickled at cache_path and reused until
+    the source file is modified again. The result is also kept in memory
+    (keyed by the source mtime), so repeated loads in one process are free"""
+    return _load_cached(source_path, os.path.getmtime(source_path), cache_path, builder)
+
+
+# --- Document templates ---
+def read_templates_json(path):
+    """Parse the templates JSON, with detect keywords lowercased once"""
+    with open(path, 'r', encoding='utf-8') as f:
+        templates = json.load(f)
+    for template in templates.get("templates", {}).values():
+        template["_detect_keywords_lower"] = [k.lower() for k in template.get("detect_keywords", [])]
+    return templates
+
+
+# --- Tax ID ---
+# Vendors identified by name instead of their printed Tax ID, checked in
+# order; each name is matched with and without the space OCR may drop
+SPECIAL_VENDOR_TAX_IDS = {
+    ("สยามคอนเทนเนอร์ เทอร์มินอล", "สยามคอนเทนเนอร์เทอร์มินอล"): "0105531101901",
+    ("สหไทย เทอร์มินอล", "สหไทยเทอร์มินอล"): "0107560000192",
+    ("มนต์โลจิสติกส์ เซอร์วิส", "มนต์โลจิสติกส์เซอร์วิส"): "0105559135291",
+}
+# Dashed (0-1234-56789-01-2) or spaced (0 123456789012) Tax ID, both found
+# in one scan; group 1 is set for the dashed form
+FORMATTED_TAX_ID_PATTERN = re.compile(r"\b(?:(\d-\d{4}-\d{5}-\d{2}-\d)|(\d\s+\d{12}))\b")
+NON_DIGIT_PATTERN = re.compile(r"\D")
+
+def find_special_vendor_tax_id(text):
+    """Return the Tax ID of the first special vendor named in text, or ''"""
+    for names, tax_id in SPECIAL_VENDOR_TAX_IDS.items():
+        if names[0] in text or names[1] in text:
+            return tax_id
+    return ""
+
+def find_formatted_tax_id(text, skip_tax_id):
+    """Digits of the first dashed Tax ID in text, else of the first spaced
+    one, ignoring skip_tax_id; '' if there is neither"""
+    spaced_id = ""
+    for match in FORMATTED_TAX_ID_PATTERN.finditer(text):
+        clean_id = NON_DIGIT_PATTERN.sub("", match.group(0))
+        if clean_id == skip_tax_id:
+            continue
+        if match.group(1):
+            return clean_id
+        if not spaced_id:
+            spaced_id = clean_id
+    return spaced_id
+
+
+# --- Vendor master ---
+# Vendor master branch values that mean head office (branch 00000)
+HQ_BRANCH_TOKENS = ['สำนักงานใหญ่', 'สนญ', 'สนญ.', 'Head Office', 'H.O.', 'HO']
+
+def normalize_vendor_branches(branch):
+    """Head office keywords -> 00000, numeric branches zero-padded to 5 digits"""
+    branch = branch.str.strip()
+    is_hq = branch.isin(HQ_BRANCH_TOKENS)
+    is_num = branch.str.isdigit().fillna(False).astype(bool)
+    return branch.mask(is_num, branch.str.zfill(5)).mask(is_hq, '00000')
+
+
+# --- Summary rows ---
+# Columns copied from each CY INSTRUCTION row to the rows after it
+CY_COLUMNS = ['CyOrg', 'CyExporter', 'CyInvoiceNo', 'CyBooking', 'CyQty', 'Containers']
+
+def fill_cy_columns(df):
+    """Sort the summary rows by Page and forward-fill each CY column from
+    the most recent CY INSTRUCTION row into the empty cells of the rows
+    that follow it. Returns the new frame.
+
+    The key text columns become pandas strings first, so the fill needs no
+    astype(str) copies; with pyarrow installed its strip/contains calls run
+    over Arrow buffers instead of per-cell Python objects.
+    """
+    for col in CY_COLUMNS:
+        if col not in df.columns:
+            df[col] = ""
+    
+    text_dtype = pd.StringDtype('pyarrow' if HAS_PYARROW else 'python')
+    for col in ('Document Type', 'VendorID_OCR', 'Branch_OCR', *CY_COLUMNS):
+        if col in df.columns:
+            df[col] = df[col].astype(text_dtype)
+    
+    if 'Page' in df.columns:
+        df = df.sort_values('Page', ascending=True).reset_index(drop=True)
+    
+    doc_types = df['Document Type'].str.strip().str.lower()
+    is_cy = doc_types.str.contains('cy|instruction', regex=True, na=False)
+    for col in CY_COLUMNS:
+        values = df[col]
+        is_blank = values.isna() | (values.str.strip() == "")
+        last_cy = values.where(is_cy & ~is_blank).ffill().fillna("")
+        fill_mask = ~is_cy & is_blank
+        df.loc[fill_mask, col] = last_cy[fill_mask]
+    return df
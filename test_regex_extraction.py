@@ -12,16 +12,93 @@ Usage: python test_regex_extraction.py
 
 import os
 import re
-import json
+import importlib.util
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import xlsxwriter
 from datetime import datetime
+from ocr_common import (
+    TEMPLATES_CACHE_FILE, fill_cy_columns, find_formatted_tax_id, find_special_vendor_tax_id,
+    load_cached, normalize_vendor_branches, read_templates_json
+)
+
+try:
+    import ahocorasick
+    HAS_AHOCORASICK = True
+except ImportError:
+    HAS_AHOCORASICK = False
+
+# Optional: Rust-based Excel reader for the vendor master; pandas only has
+# the calamine engine from 2.2 on
+PANDAS_VERSION = tuple(int(part) for part in pd.__version__.split('.')[:2])
+if importlib.util.find_spec("python_calamine") and PANDAS_VERSION >= (2, 2):
+    VENDOR_EXCEL_ENGINE = 'calamine'
+else:
+    VENDOR_EXCEL_ENGINE = None
 
 # Script directory
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 EXAMPLE_DOC_DIR = os.path.join(SCRIPT_DIR, "example_doc")
 TEMPLATES_FILE = os.path.join(SCRIPT_DIR, "document_templates.json")
 VENDOR_FILE = os.path.join(SCRIPT_DIR, "Vendor_branch.xlsx")
+# Cleaned vendor master, reused until Vendor_branch.xlsx changes
+VENDOR_CACHE_FILE = os.path.join(SCRIPT_DIR, "Vendor_branch_test.pkl")
 OUTPUT_FILE = os.path.join(EXAMPLE_DOC_DIR, "summary_ocr.xlsx")
+# Vendor master join keys (tax ID, branch)
+VENDOR_KEY_COLS = ['เลขประจำตัวผู้เสียภาษี', 'สาขา']
+# Parse with a process pool from this many .txt files up
+PARALLEL_MIN_FILES = 64
+# Threads reading .txt files ahead of the single-process parse loop
+TXT_READ_WORKERS = 8
+
+# Fixed regexes, compiled once at import (same names as Extract_Inv_local.py)
+NON_DIGIT_PATTERN = re.compile(r'\D')
+BR_TAG_PATTERN = re.compile(r'<br\s*/?>')
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+# Booking word = optional letters then optional digits; the groups tell
+# letters-only / letters+digits / digits-only apart in one match
+BOOKING_WORD_PATTERN = re.compile(r'([A-Za-z]*)(\d*)')
+AMOUNT_PATTERN = re.compile(r"([\d,]+\.\d{2})")
+DATE_FALLBACK_PATTERNS = [
+    re.compile(r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{4})'),  # dd/mm/yyyy or dd-mm-yyyy
+    re.compile(r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2})')   # dd/mm/yy or dd-mm-yy
+]
+DATE_SEPARATOR_PATTERN = re.compile(r'[-.]')
+TAX_ID_13_PATTERN = re.compile(r"\b(\d{13})\b")
+CHECKBOX_MARKS = ('☑', '✓', '✔')
+VENDOR_BRANCH_LABEL = 'สาขาที่ออกใบกำกับภาษี'
+# Lowercased literals every branch-number match contains
+BRANCH_KEYWORDS = ('สาขา', 'branch')
+CHECKED_BRANCH_PATTERN = re.compile(r'[☑✓✔]\s*สาขา(?:ที่)?\s*(\d+)')
+CHECKED_HQ_PATTERN = re.compile(r'[☑✓✔]\s*(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office)', re.IGNORECASE)
+VENDOR_BRANCH_PATTERN = re.compile(r'สาขาที่ออกใบกำกับภาษี\s*(?:คือ|:)?\s*(\d{1,5})', re.IGNORECASE)
+HQ_WITH_NUM_PATTERN = re.compile(r'(?:สำนักงานใหญ่|HEAD\s*OFFICE)\s*[:\s]?\s*(\d{5})', re.IGNORECASE)
+BRANCH_NUM_PATTERN = re.compile(r"(?:สาขา(?:ที่)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})(?!\d)", re.IGNORECASE)
+PAGE_SUFFIX_PATTERN = re.compile(r'_page(\d+)\.txt$')
+PAGE_FILE_BASE_PATTERN = re.compile(r'^(.+?)_page\d+\.txt$')
+QTY_NUMBER_PATTERN = re.compile(r'^([\d.]+)')
+
+# Template regexes compiled once (pattern string -> compiled, None if invalid)
+COMPILED_PATTERNS = {}
+
+def get_compiled_pattern(pattern):
+    if pattern not in COMPILED_PATTERNS:
+        try:
+            COMPILED_PATTERNS[pattern] = re.compile(pattern, re.IGNORECASE | re.DOTALL)
+        except re.error:
+            COMPILED_PATTERNS[pattern] = None
+    return COMPILED_PATTERNS[pattern]
+
+def precompile_template_patterns(templates):
+    """Compile every field pattern up front"""
+    configs = list(templates.get("common_fields", {}).values())
+    for template in templates.get("templates", {}).values():
+        configs.extend(template.get("fields", {}).values())
+    for config in configs:
+        if isinstance(config, dict):
+            for pattern in config.get("patterns", []):
+                get_compiled_pattern(pattern)
 
 
 def load_templates():
@@ -30,40 +107,70 @@ def load_templates():
         print(f"Error: Templates file not found: {TEMPLATES_FILE}")
         return None
     
-    with open(TEMPLATES_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    templates = load_cached(TEMPLATES_FILE, os.path.join(SCRIPT_DIR, TEMPLATES_CACHE_FILE), read_templates_json)
+    precompile_template_patterns(templates)
+    if HAS_AHOCORASICK:
+        templates["_detect_automaton"] = build_detect_automaton(templates)
+    return templates
+
+
+def read_vendor_master_excel(path):
+    """Read the vendor Excel and normalize the tax ID / branch keys"""
+    df = pd.read_excel(path, dtype=str, engine=VENDOR_EXCEL_ENGINE)
+    df.columns = df.columns.str.strip()
+    df['เลขประจำตัวผู้เสียภาษี'] = df['เลขประจำตัวผู้เสียภาษี'].fillna('').str.replace(r'\D+', '', regex=True)
+    
+    df['สาขา'] = normalize_vendor_branches(df['สาขา'])
+    
+    cols = VENDOR_KEY_COLS + ['Vendor code SAP']
+    if 'ชื่อบริษัท' in df.columns:
+        cols.append('ชื่อบริษัท')
+    
+    return df[cols]
 
 
 def load_vendor_master():
-    """Load vendor master data from Excel file"""
+    """Load vendor master data from Excel file (cached next to it as a pickle)"""
     if not os.path.exists(VENDOR_FILE):
         print(f"Warning: Vendor file not found: {VENDOR_FILE}")
         return None
     
     try:
-        df = pd.read_excel(VENDOR_FILE, dtype=str)
-        df.columns = df.columns.str.strip()
-        df['เลขประจำตัวผู้เสียภาษี'] = df['เลขประจำตัวผู้เสียภาษี'].fillna('').str.replace(r'\D', '', regex=True)
-        
-        def clean_branch(x):
-            x = str(x).strip()
-            if x in ['สำนักงานใหญ่', 'สนญ', 'สนญ.', 'Head Office', 'H.O.', 'HO']:
-                return '00000'
-            if x.isdigit():
-                return x.zfill(5)
-            return x
-        
-        df['สาขา'] = df['สาขา'].apply(clean_branch)
-        
-        cols = ['เลขประจำตัวผู้เสียภาษี', 'สาขา', 'Vendor code SAP']
-        if 'ชื่อบริษัท' in df.columns:
-            cols.append('ชื่อบริษัท')
-        
-        return df[cols]
+        df = load_cached(VENDOR_FILE, VENDOR_CACHE_FILE, read_vendor_master_excel)
     except Exception as e:
         print(f"Error loading vendor file: {e}")
         return None
+    
+    # Indexed on the join keys so main() can use df.join
+    return df.set_index(VENDOR_KEY_COLS)
+
+
+# Detect rules in priority order: (doc type, keyword must be in the first 15 lines)
+DETECT_PRIORITY = [("cy_instruction", False), ("billing_note", True), ("sahatthai_invoice", False)]
+
+def build_detect_automaton(templates):
+    """One automaton over every detect keyword -> its (priority, doc type, header only) rules"""
+    keyword_rules = {}
+    for priority, (doc_type, header_only) in enumerate(DETECT_PRIORITY):
+        template = templates.get("templates", {}).get(doc_type, {})
+        for keyword in template.get("detect_keywords", []):
+            if keyword:
+                keyword_rules.setdefault(keyword.lower(), []).append((priority, doc_type, header_only))
+    automaton = ahocorasick.Automaton()
+    for kw_low, rules in keyword_rules.items():
+        automaton.add_word(kw_low, rules)
+    automaton.make_automaton()
+    return automaton
 
+def line_prefix_end(text, line_count):
+    """Offset where the first line_count lines of text end (the newline
+    after them), or len(text) if it has fewer lines"""
+    end = -1
+    for _ in range(line_count):
+        end = text.find('\n', end + 1)
+        if end < 0:
+            return len(text)
+    return end
 
 def detect_document_type(text, templates):
     """Auto-detect document type based on keywords in text"""
@@ -71,27 +178,40 @@ def detect_document_type(text, templates):
         return "invoice"
     
     text_lower = text.lower()
-    lines = text.split('\n')
-    header_text = "\n".join(lines[:15]).lower()
-    strict_header = "\n".join(lines[:4]).lower()
+    # The header (first 15 lines) is text_lower[:header_end]; searches are
+    # bounded to it instead of copying it out
+    header_end = line_prefix_end(text_lower, 15)
+    
+    automaton = templates.get("_detect_automaton")
+    if automaton is not None:
+        # One pass over the text; header-only keywords must end inside the header
+        best = None
+        for end_idx, rules in automaton.iter(text_lower):
+            for priority, doc_type, header_only in rules:
+                if header_only and end_idx >= header_end:
+                    continue
+                if priority == 0:
+                    return doc_type
+                if best is None or priority < best[0]:
+                    best = (priority, doc_type)
+        return best[1] if best else "invoice"
     
     # Priority 1: CY INSTRUCTION
     cy_template = templates.get("templates", {}).get("cy_instruction", {})
-    for keyword in cy_template.get("detect_keywords", []):
-        if keyword.lower() in text_lower:
+    for kw_low in cy_template.get("_detect_keywords_lower", []):
+        if kw_low in text_lower:
             return "cy_instruction"
     
     # Priority 2: Billing Note
     billing_template = templates.get("templates", {}).get("billing_note", {})
-    for keyword in billing_template.get("detect_keywords", []):
-        kw_low = keyword.lower()
-        if kw_low in strict_header or kw_low in header_text:
+    for kw_low in billing_template.get("_detect_keywords_lower", []):
+        if text_lower.find(kw_low, 0, header_end) >= 0:
             return "billing_note"
     
     # Priority 3: Sahatthai Invoice
     sahatthai_template = templates.get("templates", {}).get("sahatthai_invoice", {})
-    for keyword in sahatthai_template.get("detect_keywords", []):
-        if keyword.lower() in text_lower:
+    for kw_low in sahatthai_template.get("_detect_keywords_lower", []):
+        if kw_low in text_lower:
             return "sahatthai_invoice"
     
     return "invoice"
@@ -106,18 +226,21 @@ def extract_field_by_patterns(text, patterns, options=None):
     
     for pattern in patterns:
         try:
-            match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
+            compiled = get_compiled_pattern(pattern)
+            if compiled is None:
+                continue
+            match = compiled.search(text)
             if match:
                 value = match.group(1) if match.lastindex and match.lastindex >= 1 else match.group(0)
                 
                 # Clean HTML
-                if options.get("clean_html"):
-                    value = re.sub(r'<br\s*/?>', ' ', value)
-                    value = re.sub(r'<[^>]+>', '', value)
+                if options.get("clean_html") and '<' in value:
+                    value = BR_TAG_PATTERN.sub(' ', value)
+                    value = HTML_TAG_PATTERN.sub('', value)
                 
-                # Clean whitespace
-                value = re.sub(r'[\r\n]+', ' ', value)
-                value = re.sub(r'\s+', ' ', value).strip()
+                # Collapse whitespace runs (\r and \n included) and trim; split()
+                # uses the same whitespace set as \s and skips the regex
+                value = " ".join(value.split())
                 
                 # Extract booking pattern
                 if options.get("extract_booking_pattern"):
@@ -126,20 +249,19 @@ def extract_field_by_patterns(text, patterns, options=None):
                     found_number = False
                     
                     for word in words:
-                        if re.match(r'^[A-Za-z]+$', word):
+                        booking_match = BOOKING_WORD_PATTERN.fullmatch(word)
+                        if booking_match is None:
+                            if result_parts:
+                                break
+                        elif not booking_match.group(2):
+                            # Letters only
                             if not found_number:
                                 result_parts.append(word)
-                        elif re.match(r'^[A-Za-z]+\d+$', word):
-                            result_parts.append(word)
-                            found_number = True
-                            break
-                        elif re.match(r'^\d+$', word):
+                        else:
+                            # Letters+digits or digits only
                             result_parts.append(word)
                             found_number = True
                             break
-                        else:
-                            if result_parts:
-                                break
                     
                     if result_parts:
                         value = ' '.join(result_parts)
@@ -150,13 +272,13 @@ def extract_field_by_patterns(text, patterns, options=None):
                 
                 # Check minimum digits
                 if options.get("min_digits"):
-                    digit_count = len(re.sub(r'\D', '', value))
+                    digit_count = len(NON_DIGIT_PATTERN.sub('', value))
                     if digit_count < options["min_digits"]:
                         continue
                 
                 # Clean non-digits
                 if options.get("clean_non_digits"):
-                    value = re.sub(r'\D', '', value)
+                    value = NON_DIGIT_PATTERN.sub('', value)
                     if options.get("length"):
                         value = value[:options["length"]]
                 
@@ -177,79 +299,60 @@ def extract_common_fields(text, common_fields_config):
     
     COMPANY_TAX_ID = "0105522018355"
     
-    # Special condition: if document contains "สยามคอนเทนเนอร์ เทอร์มินอล", use their Tax ID
-    SIAM_CONTAINER_TAX_ID = "0105531101901"
-    # Special condition: if document contains "สหไทย เทอร์มินอล", use their Tax ID
-    SAHATHAI_TAX_ID = "0107560000192"
-    # Special condition: if document contains "มนต์โลจิสติกส์ เซอร์วิส", use their Tax ID
-    MON_LOGISTICS_TAX_ID = "0105559135291"
-    
-    if "สยามคอนเทนเนอร์ เทอร์มินอล" in text or "สยามคอนเทนเนอร์เทอร์มินอล" in text:
-        result["tax_id"] = SIAM_CONTAINER_TAX_ID
-    elif "สหไทย เทอร์มินอล" in text or "สหไทยเทอร์มินอล" in text:
-        result["tax_id"] = SAHATHAI_TAX_ID
-    elif "มนต์โลจิสติกส์ เซอร์วิส" in text or "มนต์โลจิสติกส์เซอร์วิส" in text:
-        result["tax_id"] = MON_LOGISTICS_TAX_ID
+    special_tax_id = find_special_vendor_tax_id(text)
+    if special_tax_id:
+        result["tax_id"] = special_tax_id
     else:
         # Extract Tax ID
-        all_tax_ids = re.findall(r"\b(\d{13})\b", text)
+        all_tax_ids = TAX_ID_13_PATTERN.findall(text)
         vendor_tax_ids = [tid for tid in all_tax_ids if tid != COMPANY_TAX_ID]
         
         if vendor_tax_ids:
             result["tax_id"] = vendor_tax_ids[0]
         else:
-            all_dashed = re.findall(r"\b(\d{1}-\d{4}-\d{5}-\d{2}-\d{1})\b", text)
-            for match in all_dashed:
-                clean_id = re.sub(r"\D", "", match)
-                if clean_id != COMPANY_TAX_ID:
-                    result["tax_id"] = clean_id
-                    break
-            
-            if not result["tax_id"]:
-                spaced_matches = re.findall(r"\b(\d{1}\s+\d{12})\b", text)
-                for match in spaced_matches:
-                    clean_id = re.sub(r"\D", "", match)
-                    if clean_id != COMPANY_TAX_ID:
-                        result["tax_id"] = clean_id
-                        break
+            # Dashed form first, then spaced
+            result["tax_id"] = find_formatted_tax_id(text, COMPANY_TAX_ID)
     
     # Extract Branch
     branch_config = common_fields_config.get("branch", {})
     default_hq = branch_config.get("default_hq", "00000")
     pad_zeros = branch_config.get("pad_zeros", 5)
     
+    # The checkbox, vendor-branch and label regexes each need a literal that
+    # most pages don't contain; a substring test skips those scans entirely
+    has_checkbox = any(mark in text for mark in CHECKBOX_MARKS)
+    
     # Priority 1: Look for checked checkbox with branch (☑ สาขาที่ X)
-    checked_branch_match = re.search(r'[☑✓✔]\s*สาขา(?:ที่)?\s*(\d+)', text)
+    checked_branch_match = CHECKED_BRANCH_PATTERN.search(text) if has_checkbox else None
     if checked_branch_match:
         result["branch"] = checked_branch_match.group(1).zfill(pad_zeros)
     else:
         # Priority 2: Look for checked Head Office checkbox
-        checked_hq_match = re.search(r'[☑✓✔]\s*(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office)', text, re.IGNORECASE)
+        checked_hq_match = CHECKED_HQ_PATTERN.search(text) if has_checkbox else None
         if checked_hq_match:
             result["branch"] = default_hq
         else:
             # Priority 3: Look for "สาขาที่ออกใบกำกับภาษี คือ XXXXX" pattern (vendor's branch)
-            vendor_branch_match = re.search(r'สาขาที่ออกใบกำกับภาษี\s*(?:คือ|:)?\s*(\d{1,5})', text, re.IGNORECASE)
+            vendor_branch_match = VENDOR_BRANCH_PATTERN.search(text) if VENDOR_BRANCH_LABEL in text else None
             if vendor_branch_match:
                 result["branch"] = vendor_branch_match.group(1).zfill(pad_zeros)
             else:
                 # Priority 4: Look for "สำนักงานใหญ่ XXXXX" or "HEAD OFFICE XXXXX" (head office with number)
-                hq_with_num_match = re.search(r'(?:สำนักงานใหญ่|HEAD\s*OFFICE)\s*[:\s]?\s*(\d{5})', text, re.IGNORECASE)
+                text_lower = text.lower()
+                has_hq_label = 'สำนักงานใหญ่' in text or 'head' in text_lower
+                hq_with_num_match = HQ_WITH_NUM_PATTERN.search(text) if has_hq_label else None
                 if hq_with_num_match:
                     result["branch"] = hq_with_num_match.group(1).zfill(pad_zeros)
                 else:
                     # Priority 5: Standard branch pattern (without checkbox context)
-                    branch_match = re.search(r"(?:สาขา(?:ที่)?|Branch(?:\s*No\.?)?)\s*[:\.]?\s*(\d{1,5})(?!\d)", text, re.IGNORECASE)
+                    has_branch_label = any(k in text_lower for k in BRANCH_KEYWORDS)
+                    branch_match = BRANCH_NUM_PATTERN.search(text) if has_branch_label else None
                     if branch_match:
                         result["branch"] = branch_match.group(1).zfill(pad_zeros)
                     else:
-                        # Priority 6: Fall back to Head Office keywords (without number)
-                        ho_match = re.search(r"(?:สำนักงานใหญ่|สนญ\.?|Head\s*Office|H\.?O\.?)", text, re.IGNORECASE)
-                        if ho_match:
-                            result["branch"] = default_hq
-                        else:
-                            # Default to Head Office if nothing found
-                            result["branch"] = default_hq
+                        # Priority 6: Head Office keywords (without number) or nothing
+                        # found both fall back to Head Office
+                        result["branch"] = default_hq
     
     return result
 
@@ -311,31 +414,27 @@ def parse_ocr_data(text, templates, doc_type="auto"):
         
         # Fallback for amount
         if not value and field_config.get("fallback") == "last_amount":
-            amounts = re.findall(r"([\d,]+\.\d{2})", text)
+            amounts = AMOUNT_PATTERN.findall(text)
             value = amounts[-1] if amounts else ""
         
         # Reject 13-digit numbers for document_no
         if field_name == "document_no" and value:
-            digits_only = re.sub(r'\D', '', value)
+            digits_only = NON_DIGIT_PATTERN.sub('', value)
             if len(digits_only) == 13 and digits_only.isdigit():
                 value = ""
         
         # Fallback for date: search for common date formats if not found
         if field_name == "date" and not value:
             # Search for date patterns: xx/xx/xxxx, xx-xx-xxxx, xx.xx.xxxx, xx/xx/xx, xx-xx-xx
-            date_patterns = [
-                r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{4})',  # dd/mm/yyyy or dd-mm-yyyy
-                r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2})'   # dd/mm/yy or dd-mm-yy
-            ]
-            for date_pattern in date_patterns:
-                date_matches = re.findall(date_pattern, text)
+            for date_pattern in DATE_FALLBACK_PATTERNS:
+                date_matches = date_pattern.findall(text)
                 if date_matches:
                     value = date_matches[0]
                     break
         
         # Normalize date format: convert dashes/dots to slashes
         if field_name == "date" and value:
-            value = re.sub(r'[-.]', '/', value)
+            value = DATE_SEPARATOR_PATTERN.sub('/', value)
         
         if field_name in ["document_no", "date", "amount"]:
             result[field_name] = value
@@ -345,6 +444,104 @@ def parse_ocr_data(text, templates, doc_type="auto"):
     return result
 
 
+def read_txt_file(file_path):
+    """Return (content, None), or (None, error) if the file can't be read"""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read(), None
+    except Exception as e:
+        return None, e
+
+def process_txt_file(file_path, templates, loaded=None):
+    """Parse one page .txt into its summary row; returns (row_data, log line),
+    row_data None if the file can't be read. loaded is read_txt_file(file_path)
+    when the caller already read it"""
+    filename = os.path.basename(file_path)
+    
+    # Extract page number from filename
+    page_match = PAGE_SUFFIX_PATTERN.search(filename)
+    page_num = int(page_match.group(1)) if page_match else 0
+    
+    content, error = loaded if loaded is not None else read_txt_file(file_path)
+    if error is not None:
+        return None, f"Error reading {filename}: {error}"
+    
+    # Parse content
+    parsed = parse_ocr_data(content, templates)
+    
+    message = f"  {filename}: Type={parsed['document_type_name']}, TaxID={parsed['tax_id']}, Branch={parsed['branch']}, DocNo={parsed['document_no']}"
+    
+    # Create hyperlink formula pointing to the source PDF file
+    # Extract base filename without _pageX suffix to get PDF name
+    base_name_match = PAGE_FILE_BASE_PATTERN.match(filename)
+    if base_name_match:
+        pdf_name = base_name_match.group(1) + ".pdf"
+    else:
+        # Fallback: just replace .txt with .pdf
+        pdf_name = filename.replace('.txt', '.pdf')
+    
+    pdf_path = os.path.join(os.path.dirname(file_path), pdf_name)
+    hyperlink_formula = f'=HYPERLINK("{pdf_path}", "{filename}")'
+
+    
+    row_data = {
+        "Link PDF": hyperlink_formula,
+        "Page": page_num,
+        "Document Type": parsed["document_type_name"],
+        "VendorID_OCR": parsed["tax_id"],
+        "Branch_OCR": parsed["branch"],
+        "Document No": parsed["document_no"],
+        "Date": parsed["date"],
+        "Amount": parsed["amount"],
+    }
+    
+    # Handle CY INSTRUCTION
+    if parsed["document_type"] == "cy_instruction":
+        extra = parsed.get("extra_fields", {})
+        
+        # Build CyBooking field: Only booking number, no extra fields
+        booking_no = extra.get("cy_booking", "")
+        cy_booking = booking_no
+        
+        # Add CY-specific columns
+        row_data["CyOrg"] = extra.get("cy_org", "")
+        row_data["CyExporter"] = extra.get("cy_exporter", "")
+        row_data["CyInvoiceNo"] = extra.get("cy_invoice_no", "")
+        row_data["CyBooking"] = cy_booking
+        cy_qty = extra.get("cy_qty", "")
+        row_data["CyQty"] = cy_qty
+        
+        # Extract container count from CyQty
+        containers = ""
+        if cy_qty:
+            qty_match = QTY_NUMBER_PATTERN.match(cy_qty)
+            if qty_match:
+                try:
+                    containers = str(int(float(qty_match.group(1))))
+                except:
+                    pass
+        row_data["Containers"] = containers
+    else:
+        # Add extra fields from template for other document types
+        for field_name, value in parsed.get("extra_fields", {}).items():
+            # Convert field_name to readable label
+            label = field_name.replace("_", " ").title()
+            row_data[label] = value
+    
+    return row_data, message
+
+
+# Templates for Pool workers, set once per process by init_worker
+WORKER_TEMPLATES = None
+
+def init_worker(templates):
+    global WORKER_TEMPLATES
+    WORKER_TEMPLATES = templates
+
+def process_txt_file_in_worker(file_path):
+    return process_txt_file(file_path, WORKER_TEMPLATES)
+
+
 def main():
     print("=" * 60)
     print("Test Regex Extraction Script")
@@ -365,90 +562,31 @@ def main():
     if vendor_df is not None:
         print(f"Loaded {len(vendor_df)} vendor records")
     
-    # Get all .txt files
-    txt_files = sorted([f for f in os.listdir(EXAMPLE_DOC_DIR) if f.endswith('.txt')])
+    # Get all .txt files (scandir's DirEntry already knows the file type)
+    with os.scandir(EXAMPLE_DOC_DIR) as entries:
+        txt_files = sorted(e.name for e in entries if e.name.endswith('.txt') and e.is_file())
     print(f"\nFound {len(txt_files)} .txt files")
     print()
     
     data_rows = []
     
-    for filename in txt_files:
-        file_path = os.path.join(EXAMPLE_DOC_DIR, filename)
-        
-        # Extract page number from filename
-        page_match = re.search(r'_page(\d+)\.txt$', filename)
-        page_num = int(page_match.group(1)) if page_match else 0
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except Exception as e:
-            print(f"Error reading {filename}: {e}")
-            continue
-        
-        # Parse content
-        parsed = parse_ocr_data(content, templates)
-        
-        print(f"  {filename}: Type={parsed['document_type_name']}, TaxID={parsed['tax_id']}, Branch={parsed['branch']}, DocNo={parsed['document_no']}")
-        
-        # Create hyperlink formula pointing to the source PDF file
-        # Extract base filename without _pageX suffix to get PDF name
-        base_name_match = re.match(r'^(.+?)_page\d+\.txt$', filename)
-        if base_name_match:
-            pdf_name = base_name_match.group(1) + ".pdf"
-        else:
-            # Fallback: just replace .txt with .pdf
-            pdf_name = filename.replace('.txt', '.pdf')
-        
-        pdf_path = os.path.join(EXAMPLE_DOC_DIR, pdf_name)
-        hyperlink_formula = f'=HYPERLINK("{pdf_path}", "{filename}")'
-
-        
-        row_data = {
-            "Link PDF": hyperlink_formula,
-            "Page": page_num,
-            "Document Type": parsed["document_type_name"],
-            "VendorID_OCR": parsed["tax_id"],
-            "Branch_OCR": parsed["branch"],
-            "Document No": parsed["document_no"],
-            "Date": parsed["date"],
-            "Amount": parsed["amount"],
-        }
-        
-        # Handle CY INSTRUCTION
-        if parsed["document_type"] == "cy_instruction":
-            extra = parsed.get("extra_fields", {})
-            
-            # Build CyBooking field: Only booking number, no extra fields
-            booking_no = extra.get("cy_booking", "")
-            cy_booking = booking_no
-            
-            # Add CY-specific columns
-            row_data["CyOrg"] = extra.get("cy_org", "")
-            row_data["CyExporter"] = extra.get("cy_exporter", "")
-            row_data["CyInvoiceNo"] = extra.get("cy_invoice_no", "")
-            row_data["CyBooking"] = cy_booking
-            cy_qty = extra.get("cy_qty", "")
-            row_data["CyQty"] = cy_qty
-            
-            # Extract container count from CyQty
-            containers = ""
-            if cy_qty:
-                qty_match = re.match(r'^([\d.]+)', cy_qty)
-                if qty_match:
-                    try:
-                        containers = str(int(float(qty_match.group(1))))
-                    except:
-                        pass
-            row_data["Containers"] = containers
-        else:
-            # Add extra fields from template for other document types
-            for field_name, value in parsed.get("extra_fields", {}).items():
-                # Convert field_name to readable label
-                label = field_name.replace("_", " ").title()
-                row_data[label] = value
-        
-        data_rows.append(row_data)
+    # Parsing is CPU-bound regex work: spread big batches over processes.
+    # imap keeps file order; small batches aren't worth the worker startup
+    file_paths = [os.path.join(EXAMPLE_DOC_DIR, filename) for filename in txt_files]
+    if len(file_paths) >= PARALLEL_MIN_FILES and (os.cpu_count() or 1) > 1:
+        with multiprocessing.Pool(os.cpu_count(), initializer=init_worker, initargs=(templates,)) as pool:
+            results = list(pool.imap(process_txt_file_in_worker, file_paths, chunksize=8))
+    else:
+        # File reads release the GIL: a thread pool keeps them ahead of the
+        # parse loop, which matters on network drives and cold caches
+        with ThreadPoolExecutor(max_workers=TXT_READ_WORKERS) as read_pool:
+            results = [process_txt_file(file_path, templates, loaded)
+                       for file_path, loaded in zip(file_paths, read_pool.map(read_txt_file, file_paths))]
+    
+    for row_data, message in results:
+        print(message)
+        if row_data is not None:
+            data_rows.append(row_data)
     
     if not data_rows:
         print("No data extracted.")
@@ -479,15 +617,9 @@ def main():
         if 'Branch_OCR' in df.columns:
             df['Branch_OCR'] = df['Branch_OCR'].apply(clean_branch_code)
         
-        df = pd.merge(
-            df,
-            vendor_df,
-            left_on=['VendorID_OCR', 'Branch_OCR'],
-            right_on=['เลขประจำตัวผู้เสียภาษี', 'สาขา'],
-            how='left'
-        )
+        # vendor_df is indexed on its keys, so join leaves no key columns behind
+        df = df.join(vendor_df, on=['VendorID_OCR', 'Branch_OCR'], how='left')
         df.rename(columns={'Vendor code SAP': 'Vendor code', 'ชื่อบริษัท': 'Vendor Name'}, inplace=True)
-        df.drop(columns=['เลขประจำตัวผู้เสียภาษี', 'สาขา'], inplace=True, errors='ignore')
     else:
         df['Vendor code'] = ""
         df['Vendor Name'] = ""
@@ -510,144 +642,97 @@ def main():
     # For each Invoice row, copy CY values from the most recent 
     # CY INSTRUCTION document that appeared before it (by page order)
     # ============================================================
-    cy_columns = ['CyOrg', 'CyExporter', 'CyInvoiceNo', 'CyBooking', 'CyQty', 'Containers']
-    
-    # Ensure CY columns exist
-    for col in cy_columns:
-        if col not in df.columns:
-            df[col] = ""
-    
-    # Sort by Page to ensure correct order
-    if 'Page' in df.columns:
-        df = df.sort_values('Page', ascending=True).reset_index(drop=True)
-    
-    # Track last CY INSTRUCTION values
-    last_cy_values = {col: "" for col in cy_columns}
-    
-    # Iterate through rows and apply lookup
-    for idx, row in df.iterrows():
-        doc_type = str(row.get('Document Type', '')).strip().lower()
-        
-        # Check if this is a CY INSTRUCTION
-        if 'cy' in doc_type or 'instruction' in doc_type:
-            # Update tracked values from this CY INSTRUCTION
-            for col in cy_columns:
-                if col in df.columns:
-                    val = row.get(col, "")
-                    if pd.notna(val) and str(val).strip():
-                        last_cy_values[col] = val
-        else:
-            # For other documents (Invoice, etc.), copy the tracked CY values
-            for col in cy_columns:
-                current_val = row.get(col, "")
-                # Only fill if the current value is empty
-                if pd.isna(current_val) or str(current_val).strip() == "":
-                    df.at[idx, col] = last_cy_values[col]
+    df = fill_cy_columns(df)
     
     print(f"Applied CY lookup to {len(df)} rows")
     
     # Save to Excel with multiple sheets
     try:
-        with pd.ExcelWriter(OUTPUT_FILE, engine='openpyxl') as writer:
-            # Define sheet name mapping for document types
-            sheet_name_mapping = {
-                'invoice': 'INVOICE',
-                'ใบกำกับภาษี/Invoice': 'INVOICE',
-                'Sahatthai Invoice': 'INVOICE',
-                'sahatthai_invoice': 'INVOICE',
-                'cy_instruction': 'CY_INSTRUCTION',
-                'CY INSTRUCTION': 'CY_INSTRUCTION',
-                'billing_note': 'ใบวางบิล',
-                'ใบวางบิล/Billing Note': 'ใบวางบิล'
-            }
-            
-            # Map document types to sheet names
-            if 'Document Type' in df.columns:
-                df['_sheet_name'] = df['Document Type'].apply(
-                    lambda x: sheet_name_mapping.get(str(x).strip(), 'INVOICE') if pd.notna(x) else 'INVOICE'
-                )
-            else:
-                df['_sheet_name'] = 'INVOICE'
-            
-            # Define column configuration for each sheet (matching Extract_Inv.py)
-            sheet_columns = {
-                'INVOICE': [
-                    "Link PDF", "Page", "Document Type", 
-                    "VendorID_OCR", "Branch_OCR", "Vendor code", "Vendor Name", 
-                    "Document No", "Date", "Amount", 
-                    "CyOrg", "CyExporter", "CyInvoiceNo", "CyBooking", "CyQty", "Containers"
-                ],
-                'CY_INSTRUCTION': [
-                    "Link PDF", "Page", "Document Type", 
-                    "CyOrg", "CyExporter", "CyInvoiceNo", "CyBooking", "CyQty", "Containers", "Container_delivery"
-                ],
-                'ใบวางบิล': [
-                    "Link PDF", "Page", "Document Type", 
-                    "VendorID_OCR", "Branch_OCR", "Vendor code", "Vendor Name", 
-                    "Document No", "Date", "Amount"
-                ]
-            }
-            
-            # Group by sheet name and save each group to a separate sheet
-            grouped = df.groupby('_sheet_name', dropna=False)
+        # Define sheet name mapping for document types
+        sheet_name_mapping = {
+            'invoice': 'INVOICE',
+            'ใบกำกับภาษี/Invoice': 'INVOICE',
+            'Sahatthai Invoice': 'INVOICE',
+            'sahatthai_invoice': 'INVOICE',
+            'cy_instruction': 'CY_INSTRUCTION',
+            'CY INSTRUCTION': 'CY_INSTRUCTION',
+            'billing_note': 'ใบวางบิล',
+            'ใบวางบิล/Billing Note': 'ใบวางบิล'
+        }
+        
+        # Map document types to sheet names
+        if 'Document Type' in df.columns:
+            df['_sheet_name'] = df['Document Type'].apply(
+                lambda x: sheet_name_mapping.get(str(x).strip(), 'INVOICE') if pd.notna(x) else 'INVOICE'
+            )
+        else:
+            df['_sheet_name'] = 'INVOICE'
+        
+        # Define column configuration for each sheet (matching Extract_Inv.py)
+        sheet_columns = {
+            'INVOICE': [
+                "Link PDF", "Page", "Document Type", 
+                "VendorID_OCR", "Branch_OCR", "Vendor code", "Vendor Name", 
+                "Document No", "Date", "Amount", 
+                "CyOrg", "CyExporter", "CyInvoiceNo", "CyBooking", "CyQty", "Containers"
+            ],
+            'CY_INSTRUCTION': [
+                "Link PDF", "Page", "Document Type", 
+                "CyOrg", "CyExporter", "CyInvoiceNo", "CyBooking", "CyQty", "Containers", "Container_delivery"
+            ],
+            'ใบวางบิล': [
+                "Link PDF", "Page", "Document Type", 
+                "VendorID_OCR", "Branch_OCR", "Vendor code", "Vendor Name", 
+                "Document No", "Date", "Amount"
+            ]
+        }
+        
+        # Group by sheet name once: row positions per sheet. Adding
+        # Container_delivery below doesn't move rows, so they stay valid
+        sheet_rows = df.groupby('_sheet_name', dropna=False).indices
+        
+        # ============================================================
+        # Calculate Container_delivery for CY_INSTRUCTION:
+        # Count INVOICE rows with matching CyInvoiceNo * 0.5
+        # ============================================================
+        invoice_df = df.take(sheet_rows['INVOICE']) if 'INVOICE' in sheet_rows else pd.DataFrame()
+        
+        if 'CY_INSTRUCTION' in sheet_rows and not invoice_df.empty and 'CyInvoiceNo' in invoice_df.columns:
+            # Count invoices per CyInvoiceNo (keys stripped once, on both sides)
+            invoice_counts = invoice_df['CyInvoiceNo'].astype('string').str.strip().value_counts()
             
-            # ============================================================
-            # Calculate Container_delivery for CY_INSTRUCTION:
-            # Count INVOICE rows with matching CyInvoiceNo * 0.5
-            # ============================================================
-            invoice_df = grouped.get_group('INVOICE') if 'INVOICE' in [g[0] for g in grouped] else pd.DataFrame()
-            cy_df_temp = grouped.get_group('CY_INSTRUCTION') if 'CY_INSTRUCTION' in [g[0] for g in grouped] else None
+            # Container_delivery = invoice count * 0.5 (blank when no invoices)
+            # CY row positions come straight from the grouping above
+            cy_rows = sheet_rows['CY_INSTRUCTION']
+            cy_keys = df['CyInvoiceNo'].iloc[cy_rows].astype('string').str.strip()
+            counts = cy_keys.map(invoice_counts).where(cy_keys != '').fillna(0).astype('int64')
             
-            if cy_df_temp is not None and not invoice_df.empty and 'CyInvoiceNo' in invoice_df.columns:
-                # Count invoices per CyInvoiceNo
-                invoice_counts = invoice_df.groupby('CyInvoiceNo').size().to_dict()
-                
-                # Calculate Container_delivery for each CY row
-                def calc_container_delivery(cy_invoice_no):
-                    if pd.isna(cy_invoice_no) or str(cy_invoice_no).strip() == '':
-                        return ''
-                    count = invoice_counts.get(str(cy_invoice_no).strip(), 0)
-                    if count > 0:
-                        return str(count * 0.5)
-                    return ''
-                
-                # Apply calculation to original df for CY_INSTRUCTION rows
-                cy_mask = df['_sheet_name'] == 'CY_INSTRUCTION'
-                if 'Container_delivery' not in df.columns:
-                    df['Container_delivery'] = ''
-                df.loc[cy_mask, 'Container_delivery'] = df.loc[cy_mask, 'CyInvoiceNo'].apply(calc_container_delivery)
-                
-                # Re-group after adding Container_delivery
-                grouped = df.groupby('_sheet_name', dropna=False)
+            # One float column (NaN = no matching invoices, left blank in Excel),
+            # as in Extract_Inv.py, so the values are written as native numbers
+            df['Container_delivery'] = float('nan')
+            df.iloc[cy_rows, df.columns.get_loc('Container_delivery')] = (counts * 0.5).where(counts > 0).to_numpy()
+        
+        # Rows are streamed straight to xlsxwriter as plain tuples. constant_memory
+        # flushes each row to disk as it is written (rows go out in order), and
+        # the HYPERLINK formulas don't need the URL parser. The with block
+        # closes the workbook even if a sheet write fails
+        with xlsxwriter.Workbook(OUTPUT_FILE, {'constant_memory': True, 'strings_to_urls': False}) as workbook:
+            # Same header look as pandas' to_excel
+            header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
             
-            for sheet_name, group_df in grouped:
-                if pd.isna(sheet_name) or str(sheet_name).strip() == '':
-                    sheet_name = 'INVOICE'
-                
-                # Drop the temporary _sheet_name column
-                group_df = group_df.drop(columns=['_sheet_name'], errors='ignore')
-                
-                # Select specific columns for this sheet
-                target_cols = sheet_columns.get(str(sheet_name).strip(), sheet_columns['INVOICE'])
-                
-                # Filter existing columns only
-                available_cols = [col for col in target_cols if col in group_df.columns]
-                
-                # Add missing columns as empty (optional, but good for consistency)
-                for col in target_cols:
-                    if col not in available_cols:
-                        group_df[col] = ""
-                        available_cols.append(col)
-                
-                # Reorder columns matches the target list
-                final_cols = [col for col in target_cols if col in group_df.columns]
-                
-                # Final filtering and reordering
-                group_df = group_df[final_cols]
+            for sheet_name in sorted(sheet_rows):
+                # _sheet_name values are already the mapped names (never blank or NaN).
+                # Select this sheet's columns in order (missing ones come back
+                # empty, _sheet_name is dropped)
+                target_cols = sheet_columns.get(sheet_name, sheet_columns['INVOICE'])
+                group_df = df.take(sheet_rows[sheet_name]).reindex(columns=target_cols, fill_value='')
+                # Missing values become empty cells (xlsxwriter rejects NaN)
+                group_df = group_df.astype(object).where(group_df.notna(), None)
                 
-                # Reset index for clean output
-                group_df = group_df.reset_index(drop=True)
-                group_df.to_excel(writer, index=False, sheet_name=str(sheet_name))
+                worksheet = workbook.add_worksheet(sheet_name)
+                worksheet.write_row(0, 0, target_cols, header_format)
+                for row_num, row in enumerate(group_df.itertuples(index=False, name=None), start=1):
+                    worksheet.write_row(row_num, 0, row)
                 print(f"   -> Sheet '{sheet_name}': {len(group_df)} rows")
         
         print(f"\nSuccess! Output saved at: {OUTPUT_FILE}")